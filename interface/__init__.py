@@ -0,0 +1,5 @@
+'''
+interface package
+Support code for ml-interface.py: the persistent model server and the
+thin client that talks to it.
+'''
@@ -0,0 +1,146 @@
+'''
+Micro-batching for models that run faster in batches.
+
+Models with micro_batching = True (e.g. t5_test, where predict_batch()
+pads every request into one generate() call) get a MicroBatcher in
+server mode. Single requests from different connections are queued, and
+a worker thread gathers whatever arrives within a few milliseconds (or
+until a batch is full), groups it by input length so short requests
+aren't padded out to the longest one, and runs each group through
+predict_batch(). Each caller waits only for its own result.
+
+The delay is counted from the first request in a batch, so batching
+never adds more than ML_INTERFACE_BATCH_DELAY milliseconds of waiting to
+any request.
+'''
+
+import collections
+import concurrent.futures
+import os
+import queue
+import sys
+import threading
+import time
+
+# Largest number of requests passed to predict_batch() at once.
+MAX_BATCH_SIZE = int(os.environ.get("ML_INTERFACE_MAX_BATCH_SIZE", 8))
+
+# Milliseconds to wait for more requests after the first one arrives.
+BATCH_DELAY = float(os.environ.get("ML_INTERFACE_BATCH_DELAY", 5)) / 1000
+
+class MicroBatcher:
+    def __init__(self, model, lock, max_batch_size=MAX_BATCH_SIZE, batch_delay=BATCH_DELAY):
+        # lock is held while the model runs, so batches don't overlap with other requests to the same model.
+        self.model = model
+        self.lock = lock
+        self.max_batch_size = max_batch_size
+        self.batch_delay = batch_delay
+
+        self.requests = queue.Queue()
+        self.closed = False
+
+        self.batches = 0
+        self.batched_requests = 0
+        self.largest_batch = 0
+
+        self.thread = threading.Thread(target=self.run, name="MicroBatcher", daemon=True)
+        self.thread.start()
+
+    def predict(self, input_json):
+        return self.submit(input_json).result()
+
+    def submit(self, input_json):
+        future = concurrent.futures.Future()
+        self.requests.put((self.model.get_input_length(input_json), input_json, future))
+        return future
+
+    def get_requests(self):
+        # Waits for a request, then gathers more until batch_delay has passed since the first one,
+        # or a length bucket has a full batch.
+        request = self.requests.get()
+        if request is None:
+            return []
+        requests = [request]
+        bucket_sizes = collections.Counter([get_bucket(requests[0][0])])
+        deadline = time.monotonic() + self.batch_delay
+        while bucket_sizes.most_common(1)[0][1] < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                break
+            requests.append(request)
+            bucket_sizes[get_bucket(request[0])] += 1
+        return requests
+
+    def run(self):
+        while not self.closed:
+            requests = self.get_requests()
+
+            # Group by length, oldest group first.
+            buckets = {}
+            for request in requests:
+                buckets.setdefault(get_bucket(request[0]), []).append(request)
+
+            for bucket in buckets.values():
+                for i in range(0, len(bucket), self.max_batch_size):
+                    self.run_batch(bucket[i:i + self.max_batch_size])
+
+    def run_batch(self, batch):
+        input_jsons = [input_json for _, input_json, _ in batch]
+        futures = [future for _, _, future in batch]
+
+        try:
+            outputs = None
+            try:
+                with self.lock:
+                    outputs = list(self.model.predict_batch(input_jsons))
+            except Exception:
+                pass
+            if outputs is not None and len(outputs) != len(input_jsons):
+                print(f"Warning: predict_batch() returned {len(outputs)} outputs for {len(input_jsons)} inputs", file=sys.stderr)
+                outputs = None
+
+            if outputs is None:
+                # Something in the batch failed, run them one at a time so only that request gets the error.
+                for input_json, future in zip(input_jsons, futures):
+                    try:
+                        with self.lock:
+                            future.set_result(self.model.predict(input_json))
+                    except Exception as e:
+                        future.set_exception(e)
+                return
+
+            self.batches += 1
+            self.batched_requests += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            for output, future in zip(outputs, futures):
+                future.set_result(output)
+        finally:
+            # Whatever happened, never leave a caller waiting forever.
+            for future in futures:
+                if not future.done():
+                    future.set_exception(RuntimeError("the batch finished without a result for this request"))
+
+    def close(self):
+        # Stops the worker thread once it's done with the requests it already has.
+        # Only called when nothing is waiting on the batcher, e.g. when the model pool unloads the model.
+        self.closed = True
+        self.requests.put(None)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requests": self.batched_requests,
+            "mean_batch_size": self.batched_requests / self.batches if self.batches > 0 else 0.0,
+            "largest_batch": self.largest_batch,
+            "queued": self.requests.qsize(),
+        }
+
+def get_bucket(input_length):
+    # Lengths within a factor of two of each other share a bucket, so padding at most doubles a request.
+    return input_length.bit_length()
@@ -0,0 +1,83 @@
+'''
+Thin client for the ml-interface server.
+
+Used by ml-interface.py to forward requests to an already running server
+instead of loading the model in-process.
+'''
+
+from interface import protocol
+
+# How long to wait for the server to accept the connection before falling back.
+CONNECT_TIMEOUT = 0.5
+
+class ServerError(Exception):
+    pass
+
+class Connection:
+    # A connection can be reused for any number of requests.
+    def __init__(self, address=protocol.ADDRESS):
+        # Raises OSError if no server is listening on the address.
+        self.sock = protocol.connect(address, timeout=CONNECT_TIMEOUT)
+        # Generating a response can take a while, don't time out once connected.
+        self.sock.settimeout(None)
+        self.stream = self.sock.makefile("rwb")
+
+    def request(self, message):
+        protocol.send_message(self.stream, message)
+        response = protocol.read_message(self.stream)
+        if response is None:
+            raise ConnectionError("server closed the connection without responding")
+        return response
+
+    def predict(self, model_name, input_json):
+        response = self.request({"model": model_name, "input": input_json})
+        if "error" in response:
+            raise ServerError(response["error"])
+        return response["output"]
+
+    def predict_batch(self, model_name, input_jsons):
+        response = self.request({"model": model_name, "inputs": input_jsons})
+        if "error" in response:
+            raise ServerError(response["error"])
+        return response["outputs"]
+
+    def predict_stream(self, model_name, input_json):
+        protocol.send_message(self.stream, {"model": model_name, "input": input_json, "stream": True})
+        while True:
+            response = protocol.read_message(self.stream)
+            if response is None:
+                raise ConnectionError("server closed the connection without responding")
+            if "error" in response:
+                raise ServerError(response["error"])
+            if "output" in response:
+                return
+            yield response["chunk"]
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class RemoteModel:
+    # Looks like a model to the caller, but runs everything on the server.
+    def __init__(self, connection, model_name):
+        self.connection = connection
+        self.model_name = model_name
+
+    def predict(self, input_json):
+        return self.connection.predict(self.model_name, input_json)
+
+    def predict_batch(self, input_jsons):
+        return self.connection.predict_batch(self.model_name, input_jsons)
+
+    def predict_stream(self, input_json):
+        return self.connection.predict_stream(self.model_name, input_json)
+
+def request(message, address=protocol.ADDRESS):
+    with Connection(address) as connection:
+        return connection.request(message)
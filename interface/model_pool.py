@@ -0,0 +1,188 @@
+'''
+The models loaded by the server.
+
+Models are loaded the first time they're requested. If a memory budget
+is set, local models (the ones that run on this machine, like t5_test,
+as opposed to api clients like openai_chat) are unloaded least recently
+used first whenever the server's resident memory goes over it. Models
+that are pinned, or in the middle of a request, are never unloaded.
+
+A model's footprint is measured as the growth in resident memory while
+it loads. When a model that was unloaded is requested again, room is
+made for it before loading, so the budget isn't overshot on the way.
+
+Loading happens outside the pool's lock, so requests to models that are
+already loaded never wait on a slow load. Loads are run one at a time,
+which keeps each model's footprint measurement to itself.
+'''
+
+import contextlib
+import os
+import sys
+import threading
+import time
+
+import models
+from interface import batching
+from models.memory import get_rss, release_memory
+
+# Megabytes of resident memory the server tries to stay under, 0 for no limit.
+MEMORY_BUDGET = float(os.environ.get("ML_INTERFACE_MEMORY_BUDGET", 0))
+
+# Seconds between warnings that the budget can't be met.
+WARNING_INTERVAL = 60
+
+class PoolEntry:
+    def __init__(self, model, load_time, memory):
+        self.model = model
+        self.lock = threading.Lock()
+        self.batcher = None
+        if model.micro_batching:
+            self.batcher = batching.MicroBatcher(model, self.lock)
+
+        self.load_time = load_time
+        self.memory = memory
+        self.last_used = time.monotonic()
+        self.in_use = 0
+        self.requests = 0
+
+class ModelPool:
+    def __init__(self, memory_budget=MEMORY_BUDGET, pinned=()):
+        self.memory_budget = memory_budget * 2**20 if memory_budget else None
+        self.pinned = set(pinned)
+
+        self.entries = {}
+        # Footprint of models that have been loaded before, including unloaded ones.
+        self.footprints = {}
+        # Guards entries and the bookkeeping in them. Never held while a model loads.
+        self.lock = threading.Lock()
+        # Held while a model loads, so loads run one at a time.
+        self.load_lock = threading.Lock()
+        self.last_warning = None
+
+    def get(self, model_name):
+        # Returns the model's entry, loading it if needed.
+        # Raises ImportError, ValueError or OSError if the model doesn't exist or can't be loaded.
+        with self.lock:
+            entry = self.entries.get(model_name)
+        if entry is not None:
+            return entry
+
+        with self.load_lock:
+            # Another request may have loaded it while this one waited.
+            with self.lock:
+                entry = self.entries.get(model_name)
+            if entry is None:
+                entry = self.load(model_name)
+            return entry
+
+    @contextlib.contextmanager
+    def use(self, model_name):
+        # Marks the model as in use for the duration of a request, so it isn't unloaded underneath it.
+        while True:
+            entry = self.get(model_name)
+            with self.lock:
+                # It could have been unloaded between get() and here, if so load it again.
+                if self.entries.get(model_name) is entry:
+                    entry.in_use += 1
+                    entry.requests += 1
+                    entry.last_used = time.monotonic()
+                    break
+        try:
+            yield entry
+        finally:
+            with self.lock:
+                entry.in_use -= 1
+                entry.last_used = time.monotonic()
+                # Caches and the like grow as models are used, not just when they load.
+                # The model that was just used is the most recently used, so it's never the one to go.
+                unloaded = self.enforce_budget(keep=model_name)
+            if unloaded:
+                release_memory()
+
+    def load(self, model_name):
+        # Called with load_lock held, and without the lock.
+        if model_name in self.footprints:
+            with self.lock:
+                unloaded = self.enforce_budget(extra=self.footprints[model_name])
+            if unloaded:
+                release_memory()
+
+        print(f"Loading model {model_name}...", file=sys.stderr)
+        rss_before = get_rss()
+        start = time.perf_counter()
+        model = models.load_model(model_name)
+        load_time = time.perf_counter() - start
+        memory = max(0, get_rss() - rss_before) if rss_before is not None else None
+        if memory is not None:
+            print(f"Loaded model {model_name} in {load_time:.2f} s, {memory / 2**20:.0f} MiB", file=sys.stderr)
+
+        entry = PoolEntry(model, load_time, memory)
+        with self.lock:
+            self.entries[model_name] = entry
+            self.footprints[model_name] = memory or 0
+            unloaded = self.enforce_budget(keep=model_name)
+        if unloaded:
+            release_memory()
+        return entry
+
+    def enforce_budget(self, extra=0, keep=None):
+        # Unloads idle local models, least recently used first, until there's room for extra more bytes.
+        # Called with the lock held. Returns True if any were unloaded, in which case the caller should
+        # call release_memory() once it has released the lock.
+        if self.memory_budget is None:
+            return False
+        rss = get_rss()
+        if rss is None or rss + extra <= self.memory_budget:
+            return False
+
+        candidates = sorted(
+            (entry.last_used, model_name) for model_name, entry in self.entries.items()
+            if model_name != keep
+            and model_name not in self.pinned
+            and entry.model.local
+            and entry.in_use == 0
+        )
+        for _, model_name in candidates:
+            # The memory isn't handed back until release_memory() runs, so count on getting back what the model took to load.
+            rss -= self.unload(model_name)
+            if rss + extra <= self.memory_budget:
+                return True
+
+        # Pinned and busy models alone can be over the budget, don't repeat that on every request.
+        now = time.monotonic()
+        if self.last_warning is None or now - self.last_warning >= WARNING_INTERVAL:
+            self.last_warning = now
+            print(f"Warning: using {rss / 2**20:.0f} MiB, over the {self.memory_budget / 2**20:.0f} MiB memory budget, and there's nothing left to unload", file=sys.stderr)
+        return bool(candidates)
+
+    def unload(self, model_name):
+        # Called with the lock held, only for models that aren't in use. Returns the model's footprint.
+        # Its memory is only freed by the next release_memory(), which is slow, so it's left for after the lock is released.
+        print(f"Unloading model {model_name}...", file=sys.stderr)
+        entry = self.entries.pop(model_name)
+        if entry.batcher is not None:
+            entry.batcher.close()
+        entry.model.unload()
+        return entry.memory or 0
+
+    def items(self):
+        with self.lock:
+            return list(self.entries.items())
+
+    def stats(self):
+        # Load time (seconds) and footprint (bytes) of each loaded model, and how it's being used.
+        with self.lock:
+            now = time.monotonic()
+            return {
+                model_name: {
+                    "load_time": entry.load_time,
+                    "memory": entry.memory,
+                    "local": entry.model.local,
+                    "pinned": model_name in self.pinned,
+                    "requests": entry.requests,
+                    "in_use": entry.in_use,
+                    "idle_time": now - entry.last_used,
+                }
+                for model_name, entry in self.entries.items()
+            }
@@ -0,0 +1,64 @@
+'''
+Wire protocol shared by the ml-interface server and client.
+
+Every message is a single JSON object on its own line (newline-delimited
+JSON), sent over a Unix domain socket or a local TCP connection.
+
+Requests:
+  {"model": "<model_name>", "input": {<input json>}}
+  {"model": "<model_name>", "inputs": [{<input json>}, ...]}
+  {"model": "<model_name>", "input": {<input json>}, "stream": true}
+  {"command": "ping"}
+  {"command": "stats"}
+  {"command": "shutdown"}
+
+Responses:
+  {"output": "<model output>"}
+  {"outputs": ["<model output>", ...]}
+  {"error": "<description>"}
+
+Inputs are always sent inline, the server doesn't read input files.
+
+Streaming requests get any number of {"chunk": "<piece of output>"}
+responses as the output is generated, followed by the complete
+{"output": ...} (or an {"error": ...}).
+'''
+
+import json
+import os
+import socket
+import tempfile
+
+# Address the server listens on, and the client connects to.
+# Either a path to a Unix domain socket, or "host:port" for a local TCP port.
+DEFAULT_ADDRESS = os.path.join(tempfile.gettempdir(), f'ml-interface-{os.getuid()}.sock')
+ADDRESS = os.environ.get("ML_INTERFACE_ADDRESS") or DEFAULT_ADDRESS
+
+def parse_address(address):
+    # "host:port" (no path separators) is a TCP address, anything else is a socket path.
+    if ':' in address and '/' not in address:
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, address
+
+def connect(address, timeout=None):
+    family, addr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(addr)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def send_message(stream, message):
+    stream.write(json.dumps(message).encode("utf-8") + b'\n')
+    stream.flush()
+
+def read_message(stream):
+    # Returns None once the other side has closed the connection.
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line)
@@ -0,0 +1,202 @@
+'''
+Persistent model server.
+
+Keeps one Model instance per model name loaded, so repeated requests
+don't pay for python startup, library imports or model loading every
+time a line of dialogue is generated. With a memory budget, idle local
+models may be unloaded to make room for others, see model_pool.py.
+
+Start it with `ml-interface.py --serve`.
+'''
+
+import contextlib
+import os
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+from interface import client, model_pool, protocol
+
+# Connections waiting to be accepted. socketserver's default of 5 refuses clients when many connect at once,
+# and refused clients fall back to loading the model themselves.
+REQUEST_QUEUE_SIZE = 128
+
+class ServerRunningError(Exception):
+    pass
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+    def server_bind(self):
+        super().server_bind()
+        # Only this user can connect. Done before listen(), so there's no window where anyone else can.
+        os.chmod(self.server_address, 0o600)
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+class ModelServer:
+    def __init__(self, address=protocol.ADDRESS, memory_budget=model_pool.MEMORY_BUDGET, pinned=()):
+        # memory_budget is in megabytes, 0 for no limit. Pinned models are never unloaded.
+        self.address = address
+        self.pool = model_pool.ModelPool(memory_budget, pinned)
+        self.server = None
+
+    def get_input_error(self, request):
+        # Inputs have to be sent inline. Models also accept a path to an input file, but the server
+        # never opens files on a client's behalf, clients may not be allowed to read them (e.g. over TCP).
+        if "inputs" in request:
+            inputs = request["inputs"]
+            if not isinstance(inputs, list) or not all(isinstance(input_json, dict) for input_json in inputs):
+                return "inputs must be a list of json objects"
+        elif not isinstance(request.get("input"), dict):
+            return "input must be a json object"
+        return None
+
+    def handle_request(self, request):
+        # Yields the response(s) to a request. Streaming requests get a
+        # {"chunk": ...} response per piece of output, followed by the full
+        # {"output": ...}, everything else gets exactly one response.
+        command = request.get("command")
+        if command == "ping":
+            yield {"output": "pong"}
+            return
+        if command == "shutdown":
+            yield {"output": "shutting down"}
+            # Only once the response has been sent, the process may exit as soon as the server stops.
+            # shutdown() blocks until serve_forever() returns, so it can't be
+            # called from the handler thread directly.
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        if command == "stats":
+            yield {"output": self.get_stats()}
+            return
+        if command is not None:
+            yield {"error": f"unknown command {command}"}
+            return
+
+        input_error = self.get_input_error(request)
+        if input_error is not None:
+            yield {"error": f"invalid request: {input_error}"}
+            return
+
+        model_name = request.get("model", "")
+        try:
+            self.pool.get(model_name)
+        except (ImportError, ValueError, OSError) as e:
+            yield {"error": f"model {model_name} not found: {e}"}
+            return
+        # The model stays loaded until the last response has been sent.
+        with self.pool.use(model_name) as entry:
+            yield from self.run_model(entry, request)
+
+    def run_model(self, entry, request):
+        model = entry.model
+
+        # Single requests to batching models wait for their turn in the next batch.
+        if entry.batcher is not None and "inputs" not in request and not request.get("stream"):
+            yield {"output": entry.batcher.predict(request["input"])}
+            return
+
+        # Most models aren't written to be thread-safe, only run one request at a time for those.
+        lock = entry.lock
+        if model.thread_safe:
+            lock = contextlib.nullcontext()
+        with lock:
+            if "inputs" in request:
+                yield {"outputs": model.predict_batch(request["inputs"])}
+            elif request.get("stream"):
+                chunks = []
+                for chunk in model.predict_stream(request["input"]):
+                    chunks.append(chunk)
+                    yield {"chunk": chunk}
+                yield {"output": "".join(chunks)}
+            else:
+                yield {"output": model.predict(request["input"])}
+
+    def get_stats(self):
+        pool_stats = self.pool.stats()
+        stats = {}
+        for model_name, entry in self.pool.items():
+            stats[model_name] = dict(entry.model.get_stats())
+            if entry.batcher is not None:
+                stats[model_name]["batching"] = entry.batcher.stats()
+            if model_name in pool_stats:
+                stats[model_name]["pool"] = pool_stats[model_name]
+        return stats
+
+    def serve_forever(self, preload=()):
+        # Raises ServerRunningError if another server is already listening on the address.
+        family, addr = protocol.parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            # Clean up after a server that didn't shut down properly, but never take over from one that's running.
+            if is_listening(self.address):
+                raise ServerRunningError(f"a server is already listening on {self.address}")
+            os.unlink(addr)
+        server_class = UnixServer if family == socket.AF_UNIX else TCPServer
+
+        for model_name in preload:
+            try:
+                self.pool.get(model_name)
+            except (ImportError, ValueError, OSError) as e:
+                print(f"Error: could not preload model {model_name}: {e}", file=sys.stderr)
+
+        model_server = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def send(self, response):
+                # Returns False if the client went away.
+                try:
+                    protocol.send_message(self.wfile, response)
+                    return True
+                except OSError:
+                    return False
+
+            def handle(self):
+                # A connection may send any number of requests, one per line.
+                while True:
+                    try:
+                        request = protocol.read_message(self.rfile)
+                    except ValueError as e:
+                        if not self.send({"error": f"invalid request: {e}"}):
+                            break
+                        continue
+                    if request is None:
+                        break
+
+                    # Only failed writes mean the client is gone. Anything the model raises, OSErrors
+                    # included (e.g. a missing input file), is sent back as an error response.
+                    responses = model_server.handle_request(request)
+                    try:
+                        for response in responses:
+                            if not self.send(response):
+                                # Nothing left to respond to, let the model go.
+                                responses.close()
+                                return
+                    except Exception as e:
+                        traceback.print_exc()
+                        if not self.send({"error": f"{type(e).__name__}: {e}"}):
+                            break
+
+        with server_class(addr, RequestHandler) as server:
+            self.server = server
+            print(f"ml-interface server listening on {self.address}", file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                if family == socket.AF_UNIX and os.path.exists(addr):
+                    os.unlink(addr)
+
+def is_listening(address):
+    try:
+        protocol.connect(address, timeout=client.CONNECT_TIMEOUT).close()
+        return True
+    except OSError:
+        return False
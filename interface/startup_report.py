@@ -0,0 +1,74 @@
+'''
+Startup time report.
+
+Measures how long each model takes to start from a cold python process:
+the import of models.<model_name>.model (with a breakdown by package of
+the slowest imports from `python -X importtime`), and the construction
+of the Model.
+
+Run it with `ml-interface.py --startup-report [<model_name> ...]`.
+'''
+
+import os
+import subprocess
+import sys
+
+import models
+
+REPOSITORY_DIRECTORY = os.path.dirname(models.MODELS_DIRECTORY)
+
+# Runs inside the measured process. Prints the time taken to construct the model on the last line of stdout.
+MEASURE_SCRIPT = '''
+import time
+import models.{model_name}.model as model_module
+start = time.perf_counter()
+model_module.Model()
+print(time.perf_counter() - start)
+'''
+
+def parse_importtime(stderr):
+    # Lines look like "import time:       self [us] |  cumulative | imported package".
+    # Returns {top level package: seconds}, adding up the self time of every module in the package.
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        package = fields[2].strip().split(".")[0]
+        packages[package] = packages.get(package, 0.0) + int(fields[0]) / 1e6
+    return packages
+
+def measure_model(model_name):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", MEASURE_SCRIPT.format(model_name=model_name)],
+        cwd=REPOSITORY_DIRECTORY,
+        capture_output=True,
+        text=True,
+    )
+    imports = parse_importtime(result.stderr)
+    report = {
+        "model": model_name,
+        "import_seconds": sum(imports.values()),
+        "slowest_imports": sorted(imports.items(), key=lambda item: item[1], reverse=True),
+        "construct_seconds": None,
+        "error": None,
+    }
+
+    if result.returncode != 0:
+        # Last line of the traceback is the interesting one.
+        report["error"] = (result.stderr.strip().splitlines() or ["unknown error"])[-1]
+    else:
+        report["construct_seconds"] = float(result.stdout.strip().splitlines()[-1])
+    return report
+
+def print_report(model_names=None, top=5):
+    for model_name in model_names or models.list_models():
+        report = measure_model(model_name)
+        construct = "failed" if report["construct_seconds"] is None else f"{report['construct_seconds'] * 1000:.1f} ms"
+        print(f"{model_name}: imports {report['import_seconds'] * 1000:.1f} ms, Model() {construct}")
+        for package, seconds in report["slowest_imports"][:top]:
+            print(f"    {seconds * 1000:8.1f} ms  {package}")
+        if report["error"]:
+            print(f"    error: {report['error']}")
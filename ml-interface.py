@@ -5,42 +5,285 @@ This program acts as an interface between games and text-generating
 models.
 
 Usage: ml-interface.py <model_name> <input_json>
+       ml-interface.py <model_name> --json '<inline json>'
+       ml-interface.py <model_name> <input_json> --stream
+       ml-interface.py <model_name> --ndjson
+       ml-interface.py <model_name> --batch <requests.jsonl> <responses.jsonl>
+       ml-interface.py --serve [--preload <model_name> ...]
+       ml-interface.py --stop
+       ml-interface.py --stats
+       ml-interface.py --list-models
+       ml-interface.py --startup-report [<model_name> ...]
 
-The input json should be a path to an input json file. The details
-of that json file are left up to the specific model to interpret.
+The input json should be a path to an input json file, or "-" to read
+it from stdin. It can also be passed inline with --json. The details
+of the json are left up to the specific model to interpret.
 
 Model output will be written to stdout.
+
+With --stream, output is written to stdout as it's generated, as
+newline-delimited json: any number of {"chunk": "<piece of output>"}
+lines, followed by {"output": "<complete output>"} (or {"error": ...}).
+
+With --ndjson, requests are read from stdin as newline-delimited json,
+one input json per line. Each response is written to stdout as soon as
+it's ready, one json object per line:
+  {"output": "<model output>"}  or  {"error": "<description>"}
+
+With --batch, requests are read from a jsonl file (one input json per
+line) and passed to the model's predict_batch() in groups of
+--batch-size. Responses are written to the output jsonl file in the
+same order and format as --ndjson.
+
+Server mode:
+  --serve starts a long-lived server that keeps models loaded between
+  requests. While it's running, `ml-interface.py <model_name> <input_json>`
+  forwards the request to the server instead of loading the model itself.
+  If no server is running, the model is run in-process like before.
+
+  The server listens on a Unix domain socket by default, set the
+  ML_INTERFACE_ADDRESS environment variable (or pass --address) to a
+  socket path or "host:port" to change it.
 '''
+import argparse
+import itertools
+import json
 import sys
 
-def main():
-    if len(sys.argv) == 1:
-        print("Usage: ml-interface.py <model_name> <input_json>")
+from interface import client, protocol
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        usage="ml-interface.py <model_name> <input_json>",
+        description="Interface between games and text-generating models.")
+    parser.add_argument("model_name", nargs="?")
+    parser.add_argument("input_json", nargs="?", default='', help='path to the input json, or "-" for stdin')
+    parser.add_argument("--json", dest="inline_json", metavar="JSON", help="input json passed inline")
+    parser.add_argument("--stream", action="store_true", help="write output as it's generated, as newline-delimited json chunks")
+    parser.add_argument("--ndjson", action="store_true", help="read newline-delimited input json from stdin, write one response per line")
+    parser.add_argument("--batch", nargs=2, metavar=("REQUESTS_JSONL", "RESPONSES_JSONL"), help="run every request in a jsonl file, write responses to another jsonl file")
+    parser.add_argument("--batch-size", type=int, default=16, help="number of requests passed to the model at a time in --batch mode (default: 16)")
+    parser.add_argument("--serve", action="store_true", help="run as a persistent server that keeps models loaded")
+    parser.add_argument("--preload", nargs="*", default=[], metavar="MODEL_NAME", help="models to load when the server starts")
+    parser.add_argument("--memory-budget", type=float, metavar="MB", help="unload idle local models when the server uses more memory than this (default: $ML_INTERFACE_MEMORY_BUDGET, or no limit)")
+    parser.add_argument("--pin", nargs="*", default=[], metavar="MODEL_NAME", help="models the server never unloads")
+    parser.add_argument("--stop", action="store_true", help="stop a running server")
+    parser.add_argument("--stats", action="store_true", help="print statistics (cache hits, etc.) for the models loaded by a running server")
+    parser.add_argument("--list-models", action="store_true", help="list the available models")
+    parser.add_argument("--startup-report", nargs="*", metavar="MODEL_NAME", help="measure import and load time of each model (default: all models)")
+    parser.add_argument("--address", help="server socket path or host:port (default: $ML_INTERFACE_ADDRESS)")
+    parser.add_argument("--no-server", action="store_true", help="always run the model in-process")
+    return parser.parse_args()
+
+def get_address(args):
+    return args.address or protocol.ADDRESS
+
+def run_server(args):
+    from interface import model_pool
+    from interface.server import ModelServer, ServerRunningError
+    memory_budget = args.memory_budget if args.memory_budget is not None else model_pool.MEMORY_BUDGET
+    try:
+        ModelServer(get_address(args), memory_budget=memory_budget, pinned=args.pin).serve_forever(preload=args.preload)
+    except ServerRunningError as e:
+        print("Error: {}".format(e))
         sys.exit(1)
 
-    model_name = sys.argv[1]
-    # Override hack
-    #model_name = "dummy_readjson"
-    input_json = sys.argv[2] if len(sys.argv) > 2 else ''
+def stop_server(args):
+    try:
+        client.request({"command": "shutdown"}, address=get_address(args))
+    except OSError:
+        print("Error: no server is running")
+        sys.exit(1)
+
+def print_server_stats(args):
+    try:
+        response = client.request({"command": "stats"}, address=get_address(args))
+    except OSError:
+        print("Error: no server is running")
+        sys.exit(1)
+    print(json.dumps(response["output"], indent=2))
+
+def list_models():
+    import models
+    for model_name in models.list_models():
+        print(f"{model_name}: {models.get_model_description(model_name)}")
+
+def check_model_name(args):
+    # Listing the models doesn't import anything, so an unknown model can be reported before reading the input,
+    # the same as it was when the model was loaded first.
+    import models
+    if args.model_name not in models.list_models():
+        print("Error: model {} not found".format(args.model_name))
+        print("Available models: {}".format(", ".join(models.list_models())))
+        sys.exit(1)
+
+def read_input(args):
+    # Parse the request up front, so models (and the server) get a dict instead of a file path.
+    try:
+        if args.inline_json is not None:
+            return json.loads(args.inline_json)
+        if args.input_json == '-':
+            return json.load(sys.stdin)
+        if args.input_json:
+            with open(args.input_json, "r") as f:
+                return json.load(f)
+    except (OSError, ValueError) as e:
+        print("Error: could not read input json")
+        print(e)
+        sys.exit(1)
+    return {}
+
+def get_model(args):
+    # Returns the model to run requests with.
+    # Uses the server if one is running, otherwise loads the model in-process.
+    if not args.no_server:
+        try:
+            return client.RemoteModel(client.Connection(get_address(args)), args.model_name)
+        except OSError:
+            pass
+
+    import models
 
     # Import the model
     # Models are available under models.model_name (if it exists)
     # First, check to make sure the specified model is valid
     try:
-        model_module = __import__("models." + model_name, fromlist=["model"])
-    except ImportError as e:
-        print("Error: model {} not found".format(model_name))
+        model = models.load_model(args.model_name)
+    except (ImportError, ValueError) as e:
+        print("Error: model {} not found".format(args.model_name))
         print(e)
         sys.exit(1)
 
-    # Create an instance of the model
-    model = model_module.model.Model()
+    return model
+
+def error_response(e):
+    if isinstance(e, client.ServerError):
+        return {"error": str(e)}
+    return {"error": f"{type(e).__name__}: {e}"}
+
+def run_stream(model, input_json):
+    chunks = []
+    try:
+        for chunk in model.predict_stream(input_json):
+            chunks.append(chunk)
+            print(json.dumps({"chunk": chunk}), flush=True)
+        response = {"output": "".join(chunks)}
+    except Exception as e:
+        response = error_response(e)
+    print(json.dumps(response), flush=True)
+
+def run_ndjson(model):
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            response = {"output": model.predict(json.loads(line))}
+        except Exception as e:
+            response = error_response(e)
+        print(json.dumps(response), flush=True)
+
+def run_batch_group(model, input_jsons):
+    # Returns one response per input json.
+    try:
+        return [{"output": output} for output in model.predict_batch(input_jsons)]
+    except Exception:
+        pass
+
+    # Something in the group failed, run them one at a time to find out which one.
+    responses = []
+    for input_json in input_jsons:
+        try:
+            responses.append({"output": model.predict(input_json)})
+        except Exception as e:
+            responses.append(error_response(e))
+    return responses
+
+def run_batch(model, requests_path, responses_path, batch_size):
+    with open(requests_path, "r") as requests_file, open(responses_path, "w") as responses_file:
+        lines = (line for line in requests_file if line.strip())
+        done = 0
+
+        while True:
+            group = list(itertools.islice(lines, batch_size))
+            if not group:
+                break
+
+            # Lines that aren't valid json get an error response, everything else goes to the model.
+            responses = [None] * len(group)
+            input_jsons = []
+            input_indices = []
+            for i, line in enumerate(group):
+                try:
+                    input_jsons.append(json.loads(line))
+                    input_indices.append(i)
+                except ValueError as e:
+                    responses[i] = error_response(e)
+
+            for i, response in zip(input_indices, run_batch_group(model, input_jsons)):
+                responses[i] = response
+
+            for response in responses:
+                responses_file.write(json.dumps(response) + '\n')
+            responses_file.flush()
+
+            done += len(group)
+            print(f"{done} requests done", file=sys.stderr)
+
+def main():
+    if len(sys.argv) == 1:
+        print("Usage: ml-interface.py <model_name> <input_json>")
+        sys.exit(1)
+
+    args = parse_args()
+
+    if args.serve:
+        run_server(args)
+        return
+    if args.stop:
+        stop_server(args)
+        return
+    if args.stats:
+        print_server_stats(args)
+        return
+    if args.list_models:
+        list_models()
+        return
+    if args.startup_report is not None:
+        from interface import startup_report
+        startup_report.print_report(args.startup_report)
+        return
+    if args.model_name is None:
+        print("Usage: ml-interface.py <model_name> <input_json>")
+        sys.exit(1)
+
+    # Override hack
+    #args.model_name = "dummy_readjson"
+
+    check_model_name(args)
+    streaming_input = args.ndjson or args.batch
+    input_json = None if streaming_input else read_input(args)
+    model = get_model(args)
+
+    if args.ndjson:
+        run_ndjson(model)
+        return
+    if args.batch:
+        run_batch(model, args.batch[0], args.batch[1], args.batch_size)
+        return
+    if args.stream:
+        run_stream(model, input_json)
+        return
 
     # Run the model
-    output = model.predict(input_json)
+    try:
+        output = model.predict(input_json)
+    except (client.ServerError, ConnectionError) as e:
+        print("Error: {}".format(e))
+        sys.exit(1)
 
     # Write the output to stdout
-    print(output)
+    # Flushed straight away, tracing may still have a record to send before the process exits.
+    print(output, flush=True)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
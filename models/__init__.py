@@ -0,0 +1,94 @@
+'''
+models package
+Each model lives in its own subpackage, models.<model_name>, with a
+model.py that defines a Model class.
+
+Model classes should derive from BaseModel and implement predict().
+Models that can do better than running one request at a time should
+also override predict_batch(), and models that can produce their output
+incrementally should override predict_stream().
+
+Available models are discovered by looking for models/<model_name>/model.py
+on disk, without importing anything. The model module is only imported
+when the model is loaded, and heavy libraries should be imported inside
+the model (e.g. in Model.__init__) rather than at the top of model.py.
+'''
+
+import importlib
+import json
+import os
+
+MODELS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+class BaseModel:
+  # Whether predict() can be called from multiple threads at once.
+  # The server runs requests for models that aren't thread-safe one at a time.
+  thread_safe = False
+
+  # Whether the server should gather single requests from different clients into predict_batch() calls.
+  # Worth it for models where a batch costs about the same as one request (e.g. padded generate() calls).
+  micro_batching = False
+
+  # Whether the model runs on this machine, rather than calling out to an api.
+  # The server may unload local models to stay under its memory budget.
+  local = False
+
+  def predict(self, input_json):
+    raise NotImplementedError
+
+  def predict_batch(self, input_jsons):
+    # Default: run each request one after the other.
+    # Returns the outputs in the same order as the inputs.
+    return [self.predict(input_json) for input_json in input_jsons]
+
+  def predict_stream(self, input_json):
+    # Default: the whole response arrives as one piece.
+    # Models that can generate incrementally should yield pieces of the response as they're ready.
+    yield self.predict(input_json)
+
+  def get_input_length(self, input_json):
+    # Rough size of a request, micro-batching groups requests of similar size to save on padding.
+    return len(json.dumps(input_json))
+
+  def unload(self):
+    # Called when the server unloads the model. Release anything that would outlive the Model instance
+    # (module-level caches, shared engines, ...), the instance itself is dropped afterwards.
+    pass
+
+  def get_stats(self):
+    # Counters and other runtime information about the model, reported by the server.
+    return {}
+
+def list_models():
+  # Every models/<model_name>/ directory with a model.py in it.
+  return sorted(
+    model_name for model_name in os.listdir(MODELS_DIRECTORY)
+    if model_name.isidentifier() and os.path.isfile(os.path.join(MODELS_DIRECTORY, model_name, "model.py"))
+  )
+
+def get_model_description(model_name):
+  # The docstring at the top of model.py, read without importing the module.
+  import ast
+  with open(os.path.join(MODELS_DIRECTORY, model_name, "model.py"), "r") as f:
+    docstring = ast.get_docstring(ast.parse(f.read())) or ''
+
+  # The first line of each docstring is just the model name
+  lines = docstring.strip().splitlines()
+  if lines and lines[0].strip() in (model_name, f"{model_name} model"):
+    lines = lines[1:]
+  return " ".join(line.strip() for line in lines)
+
+def load_model(model_name):
+  # Only allow models that exist on disk, model names can come from over the socket in server mode.
+  if model_name not in list_models():
+    raise ValueError(f"no model named {model_name!r} in {MODELS_DIRECTORY}")
+
+  model_module = importlib.import_module(f"models.{model_name}.model")
+  return model_module.Model()
+
+def read_input_json(input_json):
+  # Models accept either an already-parsed request (dict), or a path to a json file.
+  if isinstance(input_json, dict):
+    return input_json
+  with open(input_json, "r") as f:
+    return json.load(f)
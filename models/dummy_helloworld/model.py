@@ -2,11 +2,15 @@
 dummy_helloworld model
 This model doesn't read the input json file, it just
 returns a static string, "Hello, world!".
+ml-interface.py still reads and parses the input json before calling
+it, so a missing or invalid input file is reported as an error.
 '''
 
 # Requirements: None
 
-class Model:
+from models import BaseModel
+
+class Model(BaseModel):
     def __init__(self):
         pass
 
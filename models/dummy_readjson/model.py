@@ -1,14 +1,18 @@
 '''
 dummy_readjson model
-This model reads the input json file and returns the contents.
+This model reads the input json and returns the contents.
+The contents are re-serialized with 2-space indentation, not returned
+as the file's original text, since requests arrive already parsed.
 '''
 
 # Requirements: None
 
-class Model:
+import json
+from models import BaseModel, read_input_json
+
+class Model(BaseModel):
     def __init__(self):
         pass
 
     def predict(self, input_json):
-        with open(input_json, "r") as f:
-            return f.read()
\ No newline at end of file
+        return json.dumps(read_input_json(input_json), indent=2)
\ No newline at end of file
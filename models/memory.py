@@ -0,0 +1,29 @@
+'''
+Memory measurement and clean-up shared by the model server, the models and the benchmarks.
+'''
+
+import gc
+import os
+
+def get_rss():
+  # Resident memory of this process in bytes, or None if it can't be measured.
+  try:
+    import psutil
+    return psutil.Process().memory_info().rss
+  except ImportError:
+    pass
+  try:
+    with open("/proc/self/statm", "r") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, AttributeError):
+    return None
+
+def release_memory():
+  # Collect objects that are no longer used now, and ask the C allocator to hand freed pages back to the OS
+  # (glibc holds on to them otherwise, and the resident size wouldn't go down).
+  gc.collect()
+  try:
+    import ctypes
+    ctypes.CDLL("libc.so.6").malloc_trim(0)
+  except (OSError, AttributeError):
+    pass
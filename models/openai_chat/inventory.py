@@ -0,0 +1,259 @@
+'''
+Inventory summary for the openai_chat prompt.
+
+Describes the actor's gold, and the largest groups of items they carry.
+Items are grouped by the first word of their name ("Iron Cuirass" and
+"Iron Greaves" make "a couple pieces of Iron armor"). The game can also
+send the groups itself, as "item_groups" in place of "items":
+
+  "actor_inventory": {
+    "gold": "13",
+    "store_gold": "0",
+    "item_groups": {
+      "Netch": {"Netch Leather Greaves": 1, "Netch Leather Cuirass": 1},
+      "Common": {"Common Shirt": 1, "Common Pants": 1}
+    }
+  }
+
+Items are sorted into categories (clothing, armor, weapons, ...) by the
+end of their name, using the suffix lists in data/item_categories.json.
+Extra category files with the same layout can be added, e.g. for items
+added by mods.
+
+The suffixes are indexed by length, so classifying an item is one dict
+lookup per distinct suffix length instead of an endswith() call per
+suffix, and results are cached, since the same items turn up in
+inventory after inventory.
+'''
+
+import functools
+import heapq
+import json
+import os
+import threading
+
+DEFAULT_CATEGORIES_PATH = os.path.join(os.path.dirname(__file__), "data", "item_categories.json")
+
+class ItemClassifier:
+  def __init__(self, categories, cache_size=4096):
+    # categories is a list of (name, suffixes) in priority order.
+    # An item belongs to the first category with a suffix its name ends with.
+    self.suffixes = {}
+    for priority, (category, suffixes) in enumerate(categories):
+      for suffix in suffixes:
+        if suffix not in self.suffixes:
+          self.suffixes[suffix] = (priority, category)
+    # Longest first, only used to keep the lookup order stable.
+    self.suffix_lengths = sorted({len(suffix) for suffix in self.suffixes}, reverse=True)
+
+    self.classify = functools.lru_cache(maxsize=cache_size)(self.find_category)
+
+  @classmethod
+  def from_files(cls, paths, cache_size=4096):
+    # Categories from later files extend the ones with the same name, new categories go after the existing ones.
+    categories = {}
+    for path in paths:
+      with open(path, "r") as f:
+        for category in json.load(f)["categories"]:
+          categories.setdefault(category["name"], []).extend(category["suffixes"])
+    return cls(list(categories.items()), cache_size=cache_size)
+
+  def find_category(self, item_name):
+    # Returns the item's category, or '' if it doesn't have one.
+    best = None
+    for length in self.suffix_lengths:
+      match = self.suffixes.get(item_name[-length:])
+      if match is not None and (best is None or match[0] < best[0]):
+        best = match
+    return best[1] if best is not None else ''
+
+  def stats(self):
+    info = self.classify.cache_info()
+    return {
+      "hits": info.hits,
+      "misses": info.misses,
+      "entries": info.currsize,
+    }
+
+item_classifier = None
+item_classifier_lock = threading.Lock()
+
+def get_item_classifier(extra_paths=()):
+  # One classifier per process, shared by every Model instance.
+  # The first call decides which files are loaded.
+  global item_classifier
+  with item_classifier_lock:
+    if item_classifier is None:
+      item_classifier = ItemClassifier.from_files([DEFAULT_CATEGORIES_PATH, *extra_paths])
+    return item_classifier
+
+def describe_inventory(actor_inventory, item_classifier=None, max_item_count=3):
+  if item_classifier is None:
+    item_classifier = get_item_classifier()
+
+  # Actor inventory
+  actor_inventory_string = 'In your possession, you have '
+
+  # Gold and Store gold
+  actor_gold = int(actor_inventory["gold"])
+  actor_owned_store_gold = int(actor_inventory["store_gold"])
+
+  if actor_gold == 0 and actor_owned_store_gold == 0:
+    # Reset the start of the string
+    actor_inventory_string = 'You do not currently posess any gold pieces, however your character may have some gold stored elsewhere depending on their background.'
+  elif actor_gold == 0 and actor_owned_store_gold > 0:
+    actor_inventory_string += f'no gold pieces on you, but the store you own has {actor_owned_store_gold} gold pieces in the lockbox.'
+  elif actor_gold > 0 and actor_owned_store_gold == 0:
+    actor_inventory_string += f'{actor_gold} gold pieces.'
+  else:
+    actor_inventory_string += f'{actor_gold} gold pieces, and the store you own has {actor_owned_store_gold} gold pieces in the lockbox.'
+
+  # Actor inventory items
+
+  # Do a rudimentary attempt at summarizing inventory contents based on shared prefixes.
+  # TODO: Possibly train a T5 model to do this automatically.
+  item_groups = get_item_groups(actor_inventory)
+  if not item_groups:
+    return actor_inventory_string
+
+  # Mention the sets of items the actor has, from most items to least items.
+  # Only the first max_item_count are used, so pick those out instead of sorting every group.
+  # nlargest keeps groups of the same size in the order they were found, same as a stable sort would.
+  largest_groups = heapq.nlargest(max_item_count, item_groups, key=lambda prefix: len(item_groups[prefix]))
+  descriptions = [describe_item_group(prefix, item_groups[prefix], item_classifier) for prefix in largest_groups]
+
+  actor_inventory_string += ' In addition, you are wearing or otherwise carrying '
+  if len(descriptions) > 1:
+    actor_inventory_string += ', '.join(descriptions[:-1]) + ', and '
+  actor_inventory_string += descriptions[-1]
+
+  if len(item_groups) > max_item_count:
+    if len(item_groups) > max_item_count * 2:
+      many_items_string = ' many'
+    else:
+      many_items_string = ''
+    actor_inventory_string += f', among{many_items_string} other things'
+  actor_inventory_string += '.'
+
+  return actor_inventory_string
+
+def get_item_groups(actor_inventory):
+  # Returns {prefix: {item_name: count}}, in the order the groups were first seen.
+  item_groups = actor_inventory.get("item_groups")
+  if item_groups is not None:
+    # The game can send a group with nothing left in it, there's nothing to describe for those.
+    return {prefix: {item_name: int(count) for item_name, count in items.items()} for prefix, items in item_groups.items() if items}
+
+  item_groups = {}
+  for item_name, count in actor_inventory["items"].items():
+    prefix = item_name.partition(' ')[0]
+    items = item_groups.get(prefix)
+    if items is None:
+      items = item_groups[prefix] = {}
+    items[item_name] = int(count)
+  return item_groups
+
+def get_items_fingerprint(actor_inventory):
+  # Something hashable that changes whenever the inventory's items do.
+  # Item order matters, it decides how ties are broken in the summary.
+  item_groups = actor_inventory.get("item_groups")
+  if item_groups is not None:
+    return tuple((prefix, tuple(items.items())) for prefix, items in item_groups.items())
+  return tuple(actor_inventory["items"].items())
+
+def describe_item_group(prefix, items, item_classifier):
+  # e.g. 'a couple pieces of Netch armor', 'a stack of Potion of Restore Health', ...
+  number_of_items_in_set = len(items)
+  first_item_name, first_item_count = next(iter(items.items()))
+
+  # Figure out the appropriate prefix (a couple of, a set of, a complete set of)
+  set_descriptor = ''
+
+  is_group_a_set = True
+
+  if prefix == 'Scroll' or prefix == 'Potion':
+    is_group_a_set = False
+
+  if number_of_items_in_set == 1:
+    # This may not be a set of items, but there may be more than one in this stack.
+    if first_item_count == 1:
+      set_descriptor = 'a'
+    elif first_item_count == 2:
+      set_descriptor = 'two'
+    elif first_item_count < 10:
+      set_descriptor = 'a few'
+    else:
+      set_descriptor = 'a stack of'
+  else:
+    if is_group_a_set:
+      # Sets of armor, weapons, etc.
+      if number_of_items_in_set == 2:
+        set_descriptor = 'a couple pieces of'
+      elif number_of_items_in_set < 7:
+        set_descriptor = 'a set of'
+      else:
+        set_descriptor = 'a complete set of'
+    else:
+      # Scrolls, potions, etc.
+      if number_of_items_in_set == 2:
+        set_descriptor = 'a couple'
+      elif number_of_items_in_set < 7:
+        set_descriptor = 'a few different types of'
+      else:
+        set_descriptor = 'a variety of'
+
+  # Figure out the set description, armor/clothing/weapons/potions, from the first item in the set that has a category.
+  category = next(filter(None, map(item_classifier.classify, items)), '')
+
+  # Robes are a special subset of clothing, check everything in the set to see if it's a robe.
+  if category == 'clothing' or category == 'robes':
+    category = 'clothing'
+    if any(item_classifier.classify(item_name) == 'robes' for item_name in items):
+      category = 'robes'
+
+  # Fixups
+  # 'a common clothing' -> 'a piece of common clothing' (correct grammar)
+  if ((category == 'clothing' or category == 'armor')
+      and number_of_items_in_set == 1):
+    set_descriptor = 'a piece of'
+
+  # 'a steel weapon' -> 'a steel longsword weapon' (be specific if there's only one item in the set)
+  if (category == 'weapon' and number_of_items_in_set == 1):
+    # Replace the shared prefix with the entire item name
+    prefix = first_item_name
+    # Alternatively:
+    # category = '' # Will trigger the "len(category) == 0" check below
+
+  # 'a Expensive robes' -> 'a set of Expensive robes'
+  if (category == 'robes' and number_of_items_in_set == 1):
+    set_descriptor = 'a set of'
+
+  # 'a set of iron weapon' -> 'a set of iron weapons'
+  if (category == 'weapon' and number_of_items_in_set > 1):
+    # 'a couple pieces of iron weapons' -> 'a couple iron weapons'
+    set_descriptor = set_descriptor.replace(' pieces of', '')
+    category = 'weapons'
+    #category = 'weaponry'
+
+  # 'a guide' -> 'a guide to Balmora'
+  # If we don't know the category, but there's more to the name than just the prefix, use that.
+  if (len(category) == 0                        # No category
+      and len(first_item_name) > len(prefix)):  # There's more to the name than just the prefix
+
+    if number_of_items_in_set == 1:
+      category = first_item_name[len(prefix):]
+      category = category.strip()
+
+      if first_item_count > 1:
+        category = f'{category}s'
+    else:
+      # More than likely this is an item with a common prefix.
+      # 'a couple pieces of guide' -> 'a couple guides'
+      set_descriptor = set_descriptor.replace(' pieces of', '')
+      prefix = f'{prefix}s'
+
+  if len(category) > 0:
+    # Only add the space if there's a category
+    category = f' {category}'
+
+  return f'{set_descriptor} {prefix}{category}'
@@ -0,0 +1,548 @@
+'''
+Prompt construction for the openai_chat model.
+
+Turns the game's input json into the conversation sent to the chat
+completion api. The descriptive text is kept in tables below, built once
+when the module is imported: threshold ladders (faction rank, reputation,
+bounty, ...) are looked up with bisect instead of if/elif chains.
+
+The parts of the prompt that only depend on who the actor is (their
+identity, faction, reputation and inventory) are rendered once into a
+persona. A PersonaCache keeps the persona for each actor across the turns
+of a conversation, and rebuilds it only when one of those fields changes,
+so each turn only renders the time, state, history and disposition.
+'''
+
+import bisect
+import collections
+import functools
+import random
+import string
+import threading
+
+from models.openai_chat import inventory, tokens
+
+class Tiers:
+  # Maps a number to a piece of text, using a sorted list of upper bounds.
+  # The text for a value is the first tier whose bound is greater than the value
+  # (i.e. "value < bound"), or the last tier if the value is past every bound.
+  def __init__(self, tiers):
+    self.bounds = [bound for bound, _ in tiers[:-1]]
+    self.texts = [compile_template(text) for _, text in tiers]
+
+  def index(self, value):
+    return bisect.bisect_right(self.bounds, value)
+
+  def __getitem__(self, value):
+    return self.texts[bisect.bisect_right(self.bounds, value)]
+
+def compile_template(template):
+  # Turns a str.format style template into a function that takes the fields as keyword arguments,
+  # by compiling it to the equivalent f-string once, up front. Much faster than calling str.format every time.
+  source = ''
+  fields = []
+  for literal, field, _, _ in string.Formatter().parse(template):
+    source += literal.replace('{', '{{').replace('}', '}}')
+    if field is not None:
+      source += '{' + field + '}'
+      if field not in fields:
+        fields.append(field)
+  # Extra keyword arguments are ignored, so every template in a table can be called the same way.
+  if not fields:
+    return lambda **_: template
+  return eval(f"lambda *, {', '.join(fields)}, **_: f{source!r}")
+
+@functools.lru_cache(maxsize=None)
+def parse_template(template):
+  return tuple((literal, field) for literal, field, _, _ in string.Formatter().parse(template))
+
+def bind_template(template, **values):
+  # Fills in the fields of a str.format style template that are known up front,
+  # and returns a function that takes the rest as keyword arguments.
+  # Cheap enough to call per persona, unlike compile_template.
+  literals = ['']
+  fields = []
+  for literal, field in parse_template(template):
+    literals[-1] += literal
+    if field is None:
+      continue
+    if field in values:
+      literals[-1] += str(values[field])
+    else:
+      fields.append(field)
+      literals.append('')
+
+  def render(**field_values):
+    parts = [literals[0]]
+    for field, literal in zip(fields, literals[1:]):
+      parts.append(str(field_values[field]))
+      parts.append(literal)
+    return ''.join(parts)
+  return render
+
+######################### Text tables
+FIRST_SYSTEM_MESSAGE = compile_template('You are "{actor_name}", a {actor_malefemale} {actor_race} {actor_class} in the world of The Elder Scrolls III: Morrowind. You should always respond in-character as "{actor_name}" using character-appropriate dialogue based on your character\'s background and personality.')
+
+# Bound per persona, see describe_actor(). Only location, time_string, date_string, optional_actor_factoid_string and actor_state_string are left for each turn.
+SECOND_SYSTEM_MESSAGE = '{actor_name}, you are a {actor_malefemale} {actor_race} {actor_class_extended} currently located in "{location}". It is {time_string}, and the date is {date_string}.{optional_actor_faction_string}{optional_actor_factoid_string} {actor_inventory_string} {actor_state_string}'
+
+THIRD_SYSTEM_MESSAGE = compile_template('A {player_malefemale} {player_race} {player_class} approaches you and introduces themself as "{player_name}".{optional_player_faction_string}{optional_player_factoid_string} {player_state_string} You begin talking.')
+
+HISTORY_SUMMARY_MESSAGE = compile_template('You and {player_name} have been talking for {conversation_length}. Earlier in the conversation: {summary}')
+
+DISPOSITION_MESSAGE = compile_template('Note: As a result of previous interactions with them, you currently {disposition_description} {player_name}.')
+
+# Faction rank, from 1-10
+ACTOR_FACTION_STRING = compile_template(' You are a member of the "{actor_faction}".')
+ACTOR_FACTION_RANK_STRINGS = Tiers([
+  (4, ' You are a low-ranking member of your faction, the "{actor_faction}".'),
+  (7, ' You are a mid-ranking member of your faction, the "{actor_faction}". You expect to be treated with respect.'),
+  (None, ' You are a high-ranking, well-known and respected member of your faction, the "{actor_faction}". You are a leader and a role model to your peers.'),
+])
+
+PLAYER_FACTION_STRING = compile_template(' {player_name} is a member of the "{player_faction}", and')
+PLAYER_FACTION_RANK_STRINGS = Tiers([
+  (4, ' they\'re a low-ranking member of their faction.'),
+  (7, ' they\'re a a mid-ranking member of their faction.'),
+  (None, ' they\'re a a high-ranking member of their faction. You should show respect for their position.'),
+])
+PLAYER_OUTRANKS_ACTOR_STRING = compile_template(' You should show respect for their position, as they outrank you.')
+
+# Reputation is a number from 0-150
+# For the player, each increase comes from completing a quest for someone.
+# NPCs have a predetermined reputation. Commoners are 0, guards are 6, Sellus Gravius is 12, etc.
+ACTOR_NO_REPUTATION_STRING = compile_template(" You don't have much of a reputation. Feel free to make up a simple backstory for yourself.")
+ACTOR_REPUTATION_STRINGS = Tiers([
+  (5, " You're not very well-known. You've done a little bit of work for a few people, but nobody really knows who you are."),
+  (10, " You've completed jobs for a few people in the past, and people are starting to know who you are."),
+  (20, " You've started to build a name for yourself. In certain circles, you're becoming well-known."),
+  (50, " People generally know who you are. You've had an impact on many people's lives."),
+  (100, " You're a well-known and respected person. You've completed many tasks for a lot of people throughout your career, and they've talked about you a lot."),
+  (None, " You're a legend. You've impacted countless people throughout your lifespan, and as a result everybody knows your name."),
+])
+
+PLAYER_REPUTATION_STRINGS = Tiers([
+  (10, " You think you might have heard of {player_name} before, but you don't know much about them."),
+  (50, " You've heard of {player_name} before and have heard rumors about their previous deeds."),
+  (100, " {player_name} is starting to become well-known throughout the land. Because they've helped so many people, they've been talked about a lot."),
+  (None, " {player_name} is a household name. Most people know someone that {player_name} has helped."),
+])
+
+PLAYER_BOUNTY_STRINGS = Tiers([
+  (50, " You've heard a rumor that someone named \"{player_name}\" has a small bounty for something minor like trespassing."),
+  (1000, " {player_name} has a bounty for something serious like assault or pickpocketing."),
+  (5000, " {player_name} is a known criminal, likely a murderer. You know they are wanted by the authorities."),
+  (None, " {player_name} is a known serial-killer, authority has made it known that the player should be fled from or killed on sight."),
+])
+
+# Health, magicka and fatigue as a fraction of their maximum.
+# Each description is built up from the stats that are below 50%, then wrapped in the template.
+ACTOR_STATE_STRINGS = {
+  "good": compile_template("You are in good health."),
+  "template": compile_template("You are {state}."),
+  "health": Tiers([(0.25, 'severely injured'), (None, 'injured')]),
+  "magicka": Tiers([(None, 'low on magicka')]),
+  "fatigue": Tiers([(0.25, 'completely exhausted'), (None, 'a little bit tired')]),
+}
+PLAYER_STATE_STRINGS = {
+  "good": compile_template("{player_name} appears to be in good health."),
+  "template": compile_template("{player_name} seems to be {state}."),
+  "health": Tiers([(0.25, 'severely injured, with open wounds visible'), (None, 'injured, bleeding slightly')]),
+  "magicka": Tiers([(None, 'drained from magicka use')]),
+  "fatigue": Tiers([(0.25, 'completely exhausted, gasping for breath'), (None, 'slightly worn-out, breathing hard')]),
+}
+
+# Levels below 5 are inexperienced, above 20 are veterans.
+ACTOR_LEVEL_STRINGS = Tiers([
+  (5, ' You are inexperienced when it comes to combat.'),
+  (21, ''),
+  (None, ' You are a veteran when it comes to combat.'),
+])
+PLAYER_LEVEL_STRINGS = Tiers([
+  (5, ' {player_name}{also_string} looks inexperienced and fresh-faced.'),
+  (21, ''),
+  (None, ' {player_name}{also_string} looks like a veteran, with many scars and a hardened expression.'),
+])
+
+# Number of messages left out of the history, in place of how long the conversation has gone on.
+CONVERSATION_LENGTH_STRINGS = Tiers([
+  (10, 'a bit'),
+  (30, 'a while'),
+  (None, 'a long time'),
+])
+
+# Disposition is checked top to bottom, with each threshold fuzzed by +/- 5,
+# to ""simulate"" micro-changes in disposition as conversation naturally progresses.
+DISPOSITION_DESCRIPTIONS = [
+  (">=", 90, 'adore'),
+  (">=", 70, 'have a positive disposition towards'),
+  ("<=", 30, 'have a negative disposition towards'),
+  ("<=", 10, 'loathe'),
+]
+
+# The fields of the input json a persona is built from. If any of them (or the actor's inventory) changes, the persona is rebuilt.
+PERSONA_FIELDS = (
+  "actor",
+  "actor_is_female",
+  "actor_race",
+  "actor_class",
+  "actor_faction",
+  "actor_faction_rank",
+  "actor_reputation",
+)
+#########################
+
+class PersonaCache:
+  # The most recently used persona of each actor, keyed on the actor's name.
+  # An entry is only reused if the actor's static fields still match, otherwise it's replaced.
+  def __init__(self, max_entries=256):
+    self.max_entries = max_entries
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+
+  def get(self, input_json):
+    actor_name = input_json["actor"]
+    fingerprint = get_persona_fingerprint(input_json)
+
+    with self.lock:
+      entry = self.entries.get(actor_name)
+      if entry is not None and entry[0] == fingerprint:
+        self.hits += 1
+        self.entries.move_to_end(actor_name)
+        return entry[1]
+
+      self.misses += 1
+      if entry is not None:
+        self.invalidations += 1
+
+    # Built outside the lock, two threads building the same persona at once is harmless.
+    persona = describe_actor(input_json)
+    with self.lock:
+      self.entries[actor_name] = (fingerprint, persona)
+      self.entries.move_to_end(actor_name)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+    return persona
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "invalidations": self.invalidations,
+        "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        "entries": len(self.entries),
+      }
+
+def get_persona_fingerprint(input_json):
+  actor_inventory = input_json["actor_inventory"]
+  return (
+    tuple(input_json[field] for field in PERSONA_FIELDS),
+    actor_inventory["gold"],
+    actor_inventory["store_gold"],
+    inventory.get_items_fingerprint(actor_inventory),
+  )
+
+def build_conversation(input_json, personas=None, history_token_budget=None, summaries=None, max_prompt_tokens=None, tokenizer=None):
+  # personas is an optional PersonaCache, without one the persona is built from scratch every time.
+  # history_token_budget limits the history to the most recent messages that fit in that many tokens, counted with tokenizer.
+  # The messages before that are summarised by summaries (a summaries.HistorySummaries), or just left out without one.
+  # If the whole conversation is over max_prompt_tokens, it's trimmed down with fit_to_budget().
+  location = input_json["location"]
+
+  month = input_json["month"]
+  day = input_json["day"]
+  date_string = f'{day} {month}'
+
+  hour = input_json["hour"]
+  pm = int(input_json["pm"]) == 1
+  am_pm_string = "p.m." if pm else "a.m."
+  time_string = f'{hour} {am_pm_string}'
+
+  player_name = input_json["player_name"]
+
+  # Everything about the actor that doesn't change from one message to the next.
+  if personas is not None:
+    actor = personas.get(input_json)
+  else:
+    actor = describe_actor(input_json)
+
+  actor_level = int(input_json["actor_level"])
+  actor_state_string = describe_state(input_json, "actor", ACTOR_STATE_STRINGS)
+  actor_state_string += ACTOR_LEVEL_STRINGS[actor_level]()
+
+  optional_player_faction_string = describe_player_faction(input_json, actor["actor_faction"], actor["actor_faction_rank"])
+  optional_player_factoid_string = describe_player_factoid(input_json)
+
+  player_state_string = describe_state(input_json, "player", PLAYER_STATE_STRINGS, player_name=player_name)
+  player_level = int(input_json["player_level"])
+  # 'also' if the actor is in the same (inexperienced or veteran) tier as the player
+  also_string = ' also' if ACTOR_LEVEL_STRINGS.index(actor_level) == PLAYER_LEVEL_STRINGS.index(player_level) else ''
+  player_state_string += PLAYER_LEVEL_STRINGS[player_level](player_name=player_name, also_string=also_string)
+
+  existing_messages = get_history_messages(input_json["history"])
+  first_kept = get_history_window(existing_messages, history_token_budget, tokenizer)
+  if first_kept > 0:
+    # Messages that didn't fit are replaced by a summary, if there's a summariser to write one.
+    optional_summary_message = []
+    if summaries is not None:
+      summary = summaries.get_summary(input_json["actor"], player_name, existing_messages[:first_kept])
+      if summary:
+        optional_summary_message.append({"role": "system", "content": HISTORY_SUMMARY_MESSAGE(
+          player_name=player_name,
+          conversation_length=CONVERSATION_LENGTH_STRINGS[first_kept](),
+          summary=summary,
+        )})
+    existing_messages = optional_summary_message + existing_messages[first_kept:]
+
+  # The prompt that the player entered, to be answered by the AI.
+  player_prompt = input_json["prompt"]
+
+  # An optional note to the model about its current disposition towards the player.
+  optional_disposition_message = []
+  disposition_description = describe_disposition(int(input_json["actor_disposition"]))
+  if disposition_description:
+    optional_disposition_message.append({"role": "system", "content": DISPOSITION_MESSAGE(disposition_description=disposition_description, player_name=player_name)})
+
+  def render(existing_messages, optional_player_factoid_string, optional_actor_factoid_string):
+    # The conversation as ChatGPT receives it.
+    return [
+      # First system message, general guidance for the model.
+      {"role": "system", "content": actor["first_system_message"]},
+
+      # Second system message, information about the character it is playing as.
+      {"role": "system", "content": actor["second_system_message"](
+        location=location,
+        time_string=time_string,
+        date_string=date_string,
+        optional_actor_factoid_string=optional_actor_factoid_string,
+        actor_state_string=actor_state_string,
+      )},
+
+      # Third system message, information about the player character.
+      {"role": "system", "content": THIRD_SYSTEM_MESSAGE(
+        player_malefemale='male' if int(input_json['player_is_female']) == 0 else 'female',
+        player_race=input_json["player_race"],
+        player_class=input_json["player_class"],
+        player_name=player_name,
+        optional_player_faction_string=optional_player_faction_string,
+        optional_player_factoid_string=optional_player_factoid_string,
+        player_state_string=player_state_string,
+      )},
+
+      # The current conversation from in-game
+      *existing_messages,
+
+      # What the player entered into the text box
+      {"role": "user", "content": player_prompt},
+
+      # An optional note to the model about its current disposition towards the player.
+      *optional_disposition_message,
+    ]
+
+  conversation = render(existing_messages, optional_player_factoid_string, actor["optional_actor_factoid_string"])
+  if max_prompt_tokens is None or tokens.conversation_fits_in_budget(conversation, max_prompt_tokens):
+    return conversation
+  return fit_to_budget(conversation, render, existing_messages, optional_player_factoid_string, actor["optional_actor_factoid_string"], max_prompt_tokens, tokenizer)
+
+def fit_to_budget(conversation, render, existing_messages, optional_player_factoid_string, optional_actor_factoid_string, max_prompt_tokens, tokenizer):
+  # Drops the least important parts of the conversation until it fits in max_prompt_tokens:
+  # the history, oldest message first, then the factoids about the player and then the actor.
+  # Nothing else can be dropped, so the conversation may still be over budget after all of that.
+  total = tokens.count_conversation_tokens(conversation, tokenizer)["total"]
+
+  dropped = 0
+  while total > max_prompt_tokens and dropped < len(existing_messages):
+    total -= tokenizer.count(existing_messages[dropped]["content"]) + tokens.TOKENS_PER_MESSAGE
+    dropped += 1
+  existing_messages = existing_messages[dropped:]
+
+  if total > max_prompt_tokens and optional_player_factoid_string:
+    optional_player_factoid_string = ''
+    total = tokens.count_conversation_tokens(render(existing_messages, optional_player_factoid_string, optional_actor_factoid_string), tokenizer)["total"]
+
+  if total > max_prompt_tokens:
+    optional_actor_factoid_string = ''
+
+  return render(existing_messages, optional_player_factoid_string, optional_actor_factoid_string)
+
+def describe_actor(input_json):
+  # Returns the actor's persona: the pieces of the prompt that only depend on the fields in PERSONA_FIELDS and the inventory.
+  actor_name = input_json["actor"]
+  actor_race = input_json["actor_race"]
+  actor_faction = input_json["actor_faction"]
+
+  # Touch-up the actor's class to rephrase '<class> Service' to something that ChatGPT understands better
+  actor_class = input_json["actor_class"]
+  actor_class_extended = actor_class
+  if actor_class.endswith(' Service'):
+    actor_class = actor_class[:-len(' Service')]
+    actor_class_extended = f'{actor_class} who offers their services to others'
+
+  actor_malefemale = 'male' if int(input_json["actor_is_female"]) == 0 else 'female'
+
+  # Actor faction description string
+  optional_actor_faction_string = ''
+  actor_faction_rank = int(input_json["actor_faction_rank"])
+  if actor_faction != '':
+    if actor_faction_rank > -1:
+      optional_actor_faction_string = ACTOR_FACTION_RANK_STRINGS[actor_faction_rank](actor_faction=actor_faction)
+    else:
+      # Generic faction description string for when rank isn't set.
+      optional_actor_faction_string = ACTOR_FACTION_STRING(actor_faction=actor_faction)
+
+  # Optional interesting factoid about the actor
+  actor_reputation = int(input_json["actor_reputation"])
+  if actor_reputation > 0:
+    optional_actor_factoid_string = ACTOR_REPUTATION_STRINGS[actor_reputation]()
+  else:
+    optional_actor_factoid_string = ACTOR_NO_REPUTATION_STRING()
+
+  return {
+    "first_system_message": FIRST_SYSTEM_MESSAGE(
+      actor_name=actor_name,
+      actor_malefemale=actor_malefemale,
+      actor_race=actor_race,
+      actor_class=actor_class,
+    ),
+    "second_system_message": bind_template(SECOND_SYSTEM_MESSAGE,
+      actor_name=actor_name,
+      actor_malefemale=actor_malefemale,
+      actor_race=actor_race,
+      actor_class_extended=actor_class_extended,
+      optional_actor_faction_string=optional_actor_faction_string,
+      actor_inventory_string=inventory.describe_inventory(input_json["actor_inventory"]),
+    ),
+    # Left out of the bound message, so it can be dropped when the prompt is over budget.
+    "optional_actor_factoid_string": optional_actor_factoid_string,
+    "actor_faction": actor_faction,
+    "actor_faction_rank": actor_faction_rank,
+  }
+
+def describe_state(input_json, who, state_strings, **format_args):
+  # Description of the actor's or player's state (health, magic, fatigue)
+  health_percentage = float(input_json[f"{who}_current_health"]) / float(input_json[f"{who}_max_health"])
+  magicka_percentage = float(input_json[f"{who}_current_magicka"]) / float(input_json[f"{who}_max_magicka"])
+  fatigue_percentage = float(input_json[f"{who}_current_fatigue"]) / float(input_json[f"{who}_max_fatigue"])
+
+  if health_percentage > 0.5 and magicka_percentage > 0.5 and fatigue_percentage > 0.5:
+    return state_strings["good"](**format_args)
+
+  # At least one stat is below 50%
+  state_string = ''
+  if health_percentage < 0.5:
+    state_string += state_strings["health"][health_percentage]()
+  if magicka_percentage < 0.5:
+    if state_string != '':
+      state_string += ', '
+    state_string += state_strings["magicka"][magicka_percentage]()
+  if fatigue_percentage < 0.5:
+    if state_string != '':
+      state_string += ', and '
+    state_string += state_strings["fatigue"][fatigue_percentage]()
+
+  return state_strings["template"](state=state_string, **format_args)
+
+def describe_player_faction(input_json, actor_faction, actor_faction_rank):
+  # "player_factions": {
+  #   "faction_name": 1,
+  #   ...
+  # Where '1' is the rank of the player in that faction from 1-10.
+  player_factions = input_json.get("player_factions")
+  if not player_factions:
+    return ''
+
+  # Only care about the highest rank faction.
+  # TODO: Prioritize the faction that the actor is a member of.
+  player_faction = max(player_factions, key=player_factions.get)
+  player_faction_rank = int(player_factions[player_faction])
+  player_name = input_json["player_name"]
+
+  optional_player_faction_string = PLAYER_FACTION_STRING(player_name=player_name, player_faction=player_faction)
+  optional_player_faction_string += PLAYER_FACTION_RANK_STRINGS[player_faction_rank]()
+  # Only mid-ranking members get the note about outranking the actor, high-ranking members are always respected.
+  if (PLAYER_FACTION_RANK_STRINGS.index(player_faction_rank) == 1
+      and actor_faction.casefold() == player_faction.casefold()
+      and actor_faction_rank < player_faction_rank):
+    optional_player_faction_string += PLAYER_OUTRANKS_ACTOR_STRING()
+  return optional_player_faction_string
+
+def describe_player_factoid(input_json):
+  # Optional interesting factoid about the player the actor may know about.
+  player_name = input_json["player_name"]
+  player_reputation = int(input_json["player_reputation"])
+  player_bounty = int(input_json["player_bounty"])
+  #player_is_werewolf = int(input_json["player_is_werewolf"])
+  #player_werewolf_kills = int(input_json["player_werewolf_kills"])
+
+  # Is the player famous enough to be recognized by this actor?
+  # Generate a number 0-150, if the number is less than the player's reputation, then the actor knows the player.
+  # Note: This will result in the ai model only sometimes knowing about the player, since it rolls separately for each message.
+  if random.randint(0, 150) < player_reputation:
+    return PLAYER_REPUTATION_STRINGS[player_reputation](player_name=player_name)
+  # Does the player have a bounty?
+  elif player_bounty > 0 and random.randint(0, 1000) < player_bounty:
+    return PLAYER_BOUNTY_STRINGS[player_bounty](player_name=player_name)
+  return ''
+
+def describe_disposition(actor_disposition):
+  # Returns None if the actor is neutral towards the player.
+  for comparison, threshold, description in DISPOSITION_DESCRIPTIONS:
+    fuzzed_threshold = threshold + (random.randint(0, 10) - 5)
+    if comparison == ">=" and actor_disposition >= fuzzed_threshold:
+      return description
+    if comparison == "<=" and actor_disposition <= fuzzed_threshold:
+      return description
+  return None
+
+# Persuasion attempts are removed from the history along with the reply to them.
+# e.g. Remove both 'Admire Fail' and 'Your tone lacks sincerity.'
+PERSUASION_MESSAGES = frozenset([
+  "Admire Fail",
+  "Intimidate Fail",
+  "Taunt Fail",
+  "Bribe Fail",
+  "Admire Success",
+  "Intimidate Success",
+  "Taunt Success",
+  "Bribe Success",
+])
+
+def get_history_messages(history):
+  # The messages from the in-game conversation.
+  # TODO: Support 'system' messages from the game, such as '<X> was removed from your inventory.'
+  existing_messages = []
+  skip_reply = False
+  for message in history:
+    if skip_reply:
+      skip_reply = False
+      continue
+    if message["text"] in PERSUASION_MESSAGES:
+      skip_reply = True
+      continue
+    existing_messages.append({
+      "role": "assistant" if message["who"] == "actor" else "user",
+      "content": message["text"]
+    })
+
+  return existing_messages
+
+def get_history_window(existing_messages, token_budget, tokenizer):
+  # Returns the index of the first message in the window: the most recent messages that fit in token_budget.
+  if token_budget is None or tokens.fits_in_budget((message["content"] for message in existing_messages), token_budget):
+    return 0
+
+  # Newest first, stop at the first message that doesn't fit.
+  tokens_used = 0
+  first_kept = len(existing_messages)
+  while first_kept > 0:
+    tokens_used += tokenizer.count(existing_messages[first_kept - 1]["content"])
+    if tokens_used > token_budget:
+      break
+    first_kept -= 1
+  return first_kept
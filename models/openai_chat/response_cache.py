@@ -0,0 +1,186 @@
+'''
+Response cache for the openai_chat model.
+
+Responses are keyed on a hash of the request sent to the api (model,
+temperature and messages), so identical requests to the same NPC in the
+same state can be answered without calling the api again.
+
+Entries are kept in an in-memory LRU, and optionally in a directory on
+disk so they survive between runs. Both expire entries after a TTL and
+evict once they hold more than max_entries.
+
+Only deterministic requests (temperature <= max_temperature) are cached
+by default. With samples > 1, higher temperature requests are cached
+too: the first `samples` responses are collected from the api, after
+which the cache rotates through them. The position in the rotation is
+saved with the entry, so separate runs carry on from each other instead
+of all returning the first sample.
+'''
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+class ResponseCache:
+  def __init__(self,
+    directory = None,
+    max_entries = 1024,
+    ttl = None,
+    max_temperature = 0.0,
+    samples = 1,
+    ):
+    self.directory = directory
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.max_temperature = max_temperature
+    self.samples = samples
+
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.misses = 0
+    self.uncacheable = 0
+
+    self.file_count = 0
+    if self.directory:
+      os.makedirs(self.directory, exist_ok=True)
+      self.file_count = len(self.list_entry_files())
+
+  def get_key(self, output_json):
+    canonical = json.dumps(output_json, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+  def is_cacheable(self, output_json):
+    return output_json.get("temperature", 1.0) <= self.max_temperature or self.samples > 1
+
+  def get(self, output_json):
+    # Returns the cached response text, or None if the api needs to be called.
+    if not self.is_cacheable(output_json):
+      with self.lock:
+        self.uncacheable += 1
+      return None
+
+    key = self.get_key(output_json)
+    with self.lock:
+      entry = self.load_entry(key)
+
+      # Still collecting samples for this request
+      if entry is None or len(entry["responses"]) < self.required_samples(output_json):
+        self.misses += 1
+        return None
+
+      self.hits += 1
+      response = entry["responses"][entry["next"] % len(entry["responses"])]
+      entry["next"] += 1
+      # Save where the rotation is up to, otherwise every new process (each turn, when it isn't run as
+      # a server) would start again from the first sample.
+      if self.directory and len(entry["responses"]) > 1:
+        self.write_entry(key, entry)
+      return response
+
+  def put(self, output_json, response):
+    if not self.is_cacheable(output_json):
+      return
+
+    key = self.get_key(output_json)
+    with self.lock:
+      entry = self.load_entry(key)
+      if entry is None:
+        entry = {"created": time.time(), "responses": [], "next": 0}
+      if len(entry["responses"]) >= self.required_samples(output_json):
+        return
+
+      entry["responses"].append(response)
+      self.entries[key] = entry
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+      if self.directory:
+        self.write_entry(key, entry)
+
+  def required_samples(self, output_json):
+    if output_json.get("temperature", 1.0) <= self.max_temperature:
+      return 1
+    return self.samples
+
+  def is_expired(self, entry):
+    return self.ttl is not None and time.time() - entry["created"] > self.ttl
+
+  def load_entry(self, key):
+    # Looks in memory first, then on disk. Expired entries are dropped.
+    entry = self.entries.get(key)
+    if entry is None and self.directory:
+      entry = self.read_entry(key)
+
+    if entry is not None and self.is_expired(entry):
+      self.entries.pop(key, None)
+      if self.directory:
+        self.remove_entry_file(key)
+      return None
+
+    if entry is not None:
+      self.entries[key] = entry
+      self.entries.move_to_end(key)
+    return entry
+
+  def get_entry_path(self, key):
+    return os.path.join(self.directory, f"{key}.json")
+
+  def read_entry(self, key):
+    try:
+      with open(self.get_entry_path(key), "r") as f:
+        return json.load(f)
+    except (OSError, ValueError):
+      return None
+
+  def write_entry(self, key, entry):
+    # Write to a temp file and rename, so other processes never see half an entry.
+    path = self.get_entry_path(key)
+    is_new_file = not os.path.exists(path)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+      json.dump(entry, f)
+    os.replace(temp_path, path)
+
+    if is_new_file:
+      self.file_count += 1
+      if self.file_count > self.max_entries:
+        self.evict_files()
+
+  def remove_entry_file(self, key):
+    try:
+      os.remove(self.get_entry_path(key))
+      self.file_count -= 1
+    except OSError:
+      pass
+
+  def list_entry_files(self):
+    return [entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")]
+
+  def evict_files(self):
+    # Trim the directory back down to max_entries files, removing the least recently written first.
+    # Other processes may share the directory, so recount instead of trusting file_count.
+    files = self.list_entry_files()
+    files.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in files[:max(0, len(files) - self.max_entries)]:
+      try:
+        os.remove(entry.path)
+      except OSError:
+        pass
+    self.file_count = min(len(files), self.max_entries)
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "uncacheable": self.uncacheable,
+        "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        "entries": len(self.entries),
+      }
@@ -0,0 +1,195 @@
+'''
+Rolling summaries of the history that's left out of the openai_chat prompt.
+
+Once a conversation is longer than the history budget, the oldest
+messages are replaced by a summary. Summaries are built incrementally:
+the summary of messages 1..N is kept, and the summary of 1..N+k is made
+from it and messages N+1..N+k, so no message is summarised twice.
+
+Summaries are cached by a hash chain over the conversation's messages
+(seeded with the actor's and player's names), so a cached summary is
+only reused when every message before it is the same.
+
+The cache is in memory, and optionally in a directory on disk. Without
+the directory the chain only carries over between turns when running as
+a server, a one-shot run summarises the whole history again every turn.
+
+The summariser is pluggable:
+  "stub"                 Offline and deterministic, quotes the start of each message. For testing.
+  "t5"                   t5-small, run locally with the t5_test model's engine.
+  "package.module:name"  name is called with no arguments and returns an object
+                         with a summarise(previous_summary, messages) method.
+'''
+
+import collections
+import hashlib
+import importlib
+import json
+import os
+import sys
+import threading
+
+class StubSummariser:
+  def __init__(self, words_per_message=8, max_characters=600):
+    self.words_per_message = words_per_message
+    self.max_characters = max_characters
+
+  def summarise(self, previous_summary, messages):
+    parts = [previous_summary] if previous_summary else []
+    for message in messages:
+      words = message["content"].split()
+      text = ' '.join(words[:self.words_per_message])
+      if len(words) > self.words_per_message:
+        text += '...'
+      speaker = "You" if message["role"] == "assistant" else "They"
+      parts.append(f'{speaker} said "{text}"')
+    summary = ' '.join(parts)
+    # Keep the most recent part if it's getting long.
+    if len(summary) > self.max_characters:
+      summary = '...' + summary[-self.max_characters:].partition(' ')[2]
+    return summary
+
+class T5Summariser:
+  def __init__(self, model_name="t5-small", max_input_tokens=512, max_length=80):
+    # Shares the t5_test model's engine, so T5 is only loaded once per process.
+    from models.t5_test import engine
+    self.engine = engine.get_engine(model_name)
+    self.max_input_tokens = max_input_tokens
+    self.max_length = max_length
+
+  def summarise(self, previous_summary, messages):
+    dialogue = ' '.join(f'{"Actor" if message["role"] == "assistant" else "Player"}: {message["content"]}' for message in messages)
+    return self.engine.generate([f"summarize: {previous_summary} {dialogue}"], max_length=self.max_length, max_input_length=self.max_input_tokens)[0]
+
+def load_summariser(spec):
+  if spec == "stub":
+    return StubSummariser()
+  if spec == "t5":
+    return T5Summariser()
+
+  module_name, _, name = spec.partition(':')
+  if not name:
+    raise ValueError(f"unknown summariser {spec!r}, expected stub, t5 or package.module:name")
+  return getattr(importlib.import_module(module_name), name)()
+
+class HistorySummaries:
+  def __init__(self, summariser, max_entries=1024, directory=None):
+    self.summariser = summariser
+    self.max_entries = max_entries
+    self.directory = directory
+
+    # Hash of messages 1..N -> summary of messages 1..N
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.summarised = 0
+    self.errors = 0
+
+    self.file_count = 0
+    if self.directory:
+      os.makedirs(self.directory, exist_ok=True)
+      self.file_count = len(self.list_entry_files())
+
+  def get_summary(self, actor_name, player_name, messages):
+    # Returns the summary of messages, or None if the summariser failed.
+    chain = get_hash_chain(actor_name, player_name, messages)
+
+    # Pick up from the longest prefix that's already been summarised.
+    with self.lock:
+      summarised_count = 0
+      previous_summary = ''
+      for count in range(len(messages), 0, -1):
+        summary = self.load_entry(chain[count - 1])
+        if summary is not None:
+          summarised_count = count
+          previous_summary = summary
+          break
+
+      if summarised_count == len(messages):
+        self.hits += 1
+        return previous_summary
+
+    try:
+      summary = self.summariser.summarise(previous_summary, messages[summarised_count:])
+    except Exception as e:
+      print(f"History summary failed, leaving out {len(messages)} message(s): {e}", file=sys.stderr)
+      with self.lock:
+        self.errors += 1
+      return None
+
+    with self.lock:
+      self.summarised += len(messages) - summarised_count
+      self.entries[chain[-1]] = summary
+      self.entries.move_to_end(chain[-1])
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+      if self.directory:
+        self.write_entry(chain[-1], summary)
+    return summary
+
+  def load_entry(self, key):
+    # Looks in memory first, then on disk. Called with the lock held.
+    summary = self.entries.get(key)
+    if summary is None and self.directory:
+      summary = self.read_entry(key)
+    if summary is not None:
+      self.entries[key] = summary
+      self.entries.move_to_end(key)
+    return summary
+
+  def get_entry_path(self, key):
+    return os.path.join(self.directory, f"{key.hex()}.json")
+
+  def read_entry(self, key):
+    try:
+      with open(self.get_entry_path(key), "r") as f:
+        return json.load(f)["summary"]
+    except (OSError, ValueError, KeyError):
+      return None
+
+  def write_entry(self, key, summary):
+    # Write to a temp file and rename, so other processes never see half an entry.
+    path = self.get_entry_path(key)
+    is_new_file = not os.path.exists(path)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+      json.dump({"summary": summary}, f)
+    os.replace(temp_path, path)
+
+    if is_new_file:
+      self.file_count += 1
+      if self.file_count > self.max_entries:
+        self.evict_files()
+
+  def list_entry_files(self):
+    return [entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")]
+
+  def evict_files(self):
+    # Trim the directory back down to max_entries files, removing the least recently written first.
+    files = self.list_entry_files()
+    files.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in files[:max(0, len(files) - self.max_entries)]:
+      try:
+        os.remove(entry.path)
+      except OSError:
+        pass
+    self.file_count = min(len(files), self.max_entries)
+
+  def stats(self):
+    with self.lock:
+      return {
+        "hits": self.hits,
+        "messages_summarised": self.summarised,
+        "errors": self.errors,
+        "entries": len(self.entries),
+      }
+
+def get_hash_chain(actor_name, player_name, messages):
+  # chain[i] identifies messages 0..i of this conversation.
+  chain = []
+  digest = hashlib.sha256(f"{actor_name}\0{player_name}".encode("utf-8")).digest()
+  for message in messages:
+    digest = hashlib.sha256(digest + f"{message['role']}\0{message['content']}".encode("utf-8")).digest()
+    chain.append(digest)
+  return chain
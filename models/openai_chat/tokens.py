@@ -0,0 +1,133 @@
+'''
+Token counting for the openai_chat prompt.
+
+Uses tiktoken, the tokenizer the api itself uses, if it's installed.
+Otherwise falls back to an approximation that splits text the same way
+tiktoken does before applying its vocabulary, and counts long words as
+several tokens. It's usually within 10% for English text, which is good
+enough for keeping the prompt inside a budget.
+
+tiktoken is only imported (and its vocabulary loaded) the first time a
+count is actually needed. It downloads the vocabulary on first use, set
+TIKTOKEN_CACHE_DIR to a directory with the vocabulary in it to run
+offline.
+
+Any other tokenizer can be plugged in with a "package.module:name"
+spec, where name is called with the model name and returns an object
+with a count(text) method.
+'''
+
+import importlib
+import re
+import threading
+
+# Every message in a chat completion request costs a few tokens on top of its content,
+# and the reply is primed with a few more. (From OpenAI's cookbook, for gpt-3.5-turbo and gpt-4.)
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# Roughly the pre-tokenizer pattern used by the gpt-3.5/gpt-4 vocabulary.
+APPROXIMATE_TOKEN_PATTERN = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+")
+
+# Pieces longer than this are counted as more than one token.
+APPROXIMATE_CHARACTERS_PER_TOKEN = 6
+
+class ApproximateTokenizer:
+  name = "approximate"
+
+  def count(self, text):
+    return sum(1 + len(piece) // APPROXIMATE_CHARACTERS_PER_TOKEN for piece in APPROXIMATE_TOKEN_PATTERN.findall(text))
+
+class TiktokenTokenizer:
+  name = "tiktoken"
+
+  def __init__(self, model_name):
+    import tiktoken
+    try:
+      self.encoding = tiktoken.encoding_for_model(model_name)
+    except KeyError:
+      self.encoding = tiktoken.get_encoding("cl100k_base")
+
+  def count(self, text):
+    return len(self.encoding.encode(text, disallowed_special=()))
+
+def load_tokenizer(spec, model_name):
+  # spec is "auto" (tiktoken if it can be loaded, otherwise approximate), "tiktoken", "approximate",
+  # or "package.module:name" for anything else.
+  if spec == "auto":
+    try:
+      return TiktokenTokenizer(model_name)
+    except Exception:
+      # Not installed, or the vocabulary couldn't be downloaded.
+      return ApproximateTokenizer()
+  if spec == "tiktoken":
+    return TiktokenTokenizer(model_name)
+  if spec == "approximate":
+    return ApproximateTokenizer()
+
+  module_name, _, name = spec.partition(':')
+  if not name:
+    raise ValueError(f"unknown tokenizer {spec!r}, expected auto, tiktoken, approximate or package.module:name")
+  return getattr(importlib.import_module(module_name), name)(model_name)
+
+class LazyTokenizer:
+  # Loads the real tokenizer on first use, so requests that never need a count don't pay for it.
+  def __init__(self, model_name, spec="auto"):
+    self.model_name = model_name
+    self.spec = spec
+    self.tokenizer = None
+    self.lock = threading.Lock()
+
+  @property
+  def name(self):
+    return getattr(self.get_tokenizer(), "name", self.spec)
+
+  def get_tokenizer(self):
+    with self.lock:
+      if self.tokenizer is None:
+        self.tokenizer = load_tokenizer(self.spec, self.model_name)
+      return self.tokenizer
+
+  def count(self, text):
+    return self.get_tokenizer().count(text)
+
+def fits_in_budget(texts, token_budget):
+  # Every token is at least one byte, so texts that are small enough in bytes
+  # can be let through without loading the tokenizer at all.
+  return sum(len(text.encode("utf-8")) for text in texts) <= token_budget
+
+def conversation_fits_in_budget(conversation, token_budget):
+  # Same shortcut as fits_in_budget, for a whole chat completion request.
+  overhead = TOKENS_PER_MESSAGE * len(conversation) + TOKENS_PER_REPLY
+  return fits_in_budget((message["content"] for message in conversation), token_budget - overhead)
+
+def count_conversation_tokens(conversation, tokenizer):
+  # Returns the number of tokens each message costs, and the total for the request.
+  counts = [tokenizer.count(message["content"]) + TOKENS_PER_MESSAGE for message in conversation]
+  return {
+    "messages": counts,
+    "total": sum(counts) + TOKENS_PER_REPLY,
+  }
+
+class TokenUsage:
+  # Running totals of the prompt token counts, for get_stats().
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.total = 0
+    self.max = 0
+
+  def record(self, counts):
+    with self.lock:
+      self.requests += 1
+      self.total += counts["total"]
+      self.max = max(self.max, counts["total"])
+
+  def stats(self):
+    with self.lock:
+      return {
+        "requests": self.requests,
+        "total": self.total,
+        "mean": self.total / self.requests if self.requests > 0 else 0.0,
+        "max": self.max,
+      }
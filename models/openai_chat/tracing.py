@@ -0,0 +1,285 @@
+'''
+Message tracing for the openai_chat model.
+
+Trace records ({input_json, output_json, api_output, trace_id}) are
+gzipped and sent to an Azure Storage Queue, or written to a local
+directory, by a background thread. The response path only puts the record on an
+in-memory queue and never waits on the network.
+
+If the sink can't be reached, records are appended to a local journal
+file (one base64 encoded record per line), which is replayed the next
+time a send succeeds.
+
+Records still waiting when the process exits are sent by close() before
+it returns, from the exiting thread. The queue's network timeouts are
+kept short (SEND_TIMEOUT) so this can't hold up exiting for long, and
+anything that can't be sent in time is journaled for the next process.
+For one-shot runs of ml-interface.py, which exit right after every
+response, this is how each turn's trace goes out: the reply is printed
+first, then the process spends one round trip to the queue sending the
+trace before it exits.
+
+Each record is still sent as its own queue message, since that's what
+the queue-to-CosmosDB function consumes.
+'''
+
+import atexit
+import base64
+import gzip
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+
+# Seconds to wait on the queue to connect, or to answer, before giving up on a send.
+# Failed sends are journaled and retried later, so there's no need to wait long or retry straight away.
+SEND_TIMEOUT = 5
+
+class QueueSink:
+  # Sends each record to an Azure Storage Queue.
+  def __init__(self, connection_string, queue_name, timeout=SEND_TIMEOUT):
+    from azure.storage.queue import QueueClient, BinaryBase64EncodePolicy
+    self.queue_client = QueueClient.from_connection_string(connection_string, queue_name=queue_name,
+      connection_timeout=timeout, read_timeout=timeout, retry_total=0)
+    self.queue_client.message_encode_policy = BinaryBase64EncodePolicy()
+
+  def send(self, blobs):
+    # Returns the number of blobs sent before the first failure, raises only if none were sent.
+    for i, blob in enumerate(blobs):
+      try:
+        self.queue_client.send_message(self.queue_client.message_encode_policy.encode(blob))
+      except Exception:
+        if i == 0:
+          raise
+        return i
+    return len(blobs)
+
+class DirectorySink:
+  # Local stand-in for the queue, for testing and for collecting traces without Azure.
+  # Writes one file per batch, one base64 encoded record per line (the same encoding as the queue messages).
+  def __init__(self, directory):
+    self.directory = directory
+    os.makedirs(self.directory, exist_ok=True)
+
+  def send(self, blobs):
+    file_name = f"traces-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.b64"
+    temp_path = os.path.join(self.directory, f".{file_name}.tmp")
+    with open(temp_path, "w") as f:
+      for blob in blobs:
+        f.write(base64.b64encode(blob).decode("ascii") + '\n')
+    os.replace(temp_path, os.path.join(self.directory, file_name))
+    return len(blobs)
+
+class TraceWriter:
+  def __init__(self,
+    sink,
+    journal_path,
+    max_queue_size = 1000,
+    batch_size = 32,
+    batch_delay = 0.5,
+    shutdown_timeout = 1.0,
+    ):
+    self.sink = sink
+    self.journal_path = journal_path
+    self.batch_size = batch_size
+    self.batch_delay = batch_delay
+    self.shutdown_timeout = shutdown_timeout
+
+    self.records = queue.Queue(maxsize=max_queue_size)
+    self.journal_lock = threading.Lock()
+    self.closed = False
+    # Records the writer thread had picked up when close() stopped it, for close() to send.
+    self.leftover = []
+
+    self.sent = 0
+    self.journaled = 0
+
+    self.thread = threading.Thread(target=self.run, name="TraceWriter", daemon=True)
+    self.thread.start()
+    atexit.register(self.close)
+
+  def submit(self, record):
+    # Never blocks: if the writer has fallen too far behind, the record goes straight to the journal.
+    # Every record gets a unique trace_id, so identical turns can still be told apart downstream.
+    record = dict(record, trace_id=str(uuid.uuid4()))
+    try:
+      self.records.put_nowait(record)
+    except queue.Full:
+      self.write_journal([self.encode(record)])
+
+  def encode(self, record):
+    # mtime=0 so the bytes only depend on the record, not on when it was compressed.
+    return gzip.compress(json.dumps(record).encode("utf-8"), mtime=0)
+
+  def get_batch(self):
+    # Waits for a record, then gathers up to batch_size records for at most batch_delay seconds.
+    batch = [self.records.get()]
+    deadline = time.monotonic() + self.batch_delay
+    while len(batch) < self.batch_size:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        break
+      try:
+        record = self.records.get(timeout=remaining)
+      except queue.Empty:
+        break
+      batch.append(record)
+      if record is None:
+        # close() was called, don't keep it waiting for the rest of the batch.
+        break
+    return batch
+
+  def run(self):
+    # Send anything earlier runs couldn't.
+    self.replay_journal()
+
+    while True:
+      batch = self.get_batch()
+      if None in batch:
+        # close() was called, it sends what's left itself.
+        self.leftover = [record for record in batch if record is not None]
+        return
+
+      blobs = [self.encode(record) for record in batch]
+
+      if self.send(blobs):
+        self.replay_journal()
+
+  def send(self, blobs):
+    # Returns True if everything was sent, anything that wasn't goes to the journal.
+    try:
+      sent = self.sink.send(blobs)
+    except Exception as e:
+      print(f"Tracing: send failed, journaling {len(blobs)} record(s): {e}", file=sys.stderr)
+      sent = 0
+
+    self.sent += sent
+    if sent < len(blobs):
+      self.write_journal(blobs[sent:])
+      return False
+    return True
+
+  def write_journal(self, blobs):
+    with self.journal_lock:
+      os.makedirs(os.path.dirname(self.journal_path) or '.', exist_ok=True)
+      with open(self.journal_path, "a") as f:
+        for blob in blobs:
+          f.write(base64.b64encode(blob).decode("ascii") + '\n')
+      self.journaled += len(blobs)
+
+  def claim_journal(self):
+    # Moves the journal, and anything left over from earlier processes that exited mid-replay,
+    # to replay files owned by this process. Renames are atomic, so two processes never claim the same records.
+    journal_directory = os.path.dirname(self.journal_path) or '.'
+    journal_name = os.path.basename(self.journal_path)
+    claimed = []
+
+    with self.journal_lock:
+      if os.path.exists(self.journal_path):
+        replay_path = f"{self.journal_path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.replay"
+        os.replace(self.journal_path, replay_path)
+        claimed.append(replay_path)
+
+    if not os.path.isdir(journal_directory):
+      return claimed
+
+    for file_name in os.listdir(journal_directory):
+      if not file_name.startswith(journal_name + '.') or not file_name.endswith('.replay'):
+        continue
+      path = os.path.join(journal_directory, file_name)
+      if path in claimed:
+        continue
+      owner_pid = file_name[len(journal_name) + 1:].split('.')[0]
+      if not owner_pid.isdigit() or (int(owner_pid) != os.getpid() and is_process_running(int(owner_pid))):
+        continue
+      replay_path = f"{self.journal_path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.replay"
+      try:
+        os.replace(path, replay_path)
+        claimed.append(replay_path)
+      except OSError:
+        pass
+
+    return claimed
+
+  def replay_journal(self):
+    for replay_path in self.claim_journal():
+      with open(replay_path, "r") as f:
+        blobs = [base64.b64decode(line) for line in f if line.strip()]
+
+      while blobs:
+        if self.closed:
+          # Exiting, leave the rest of the file for the next process to pick up.
+          return
+        batch, blobs = blobs[:self.batch_size], blobs[self.batch_size:]
+        if not self.send(batch):
+          # The failed batch is journaled again by send(), the rest goes with it.
+          self.write_journal(blobs)
+          blobs = []
+          break
+        # Keep the replay file up to date, so records aren't sent twice if the process exits part way through.
+        with open(replay_path, "w") as f:
+          for blob in blobs:
+            f.write(base64.b64encode(blob).decode("ascii") + '\n')
+
+      os.remove(replay_path)
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+
+    # Stop the writer thread, giving it a moment to finish anything it's in the middle of sending.
+    try:
+      self.records.put_nowait(None)
+    except queue.Full:
+      pass
+    self.thread.join(self.shutdown_timeout)
+
+    remaining = []
+    if not self.thread.is_alive():
+      remaining.extend(self.leftover)
+    while True:
+      try:
+        record = self.records.get_nowait()
+      except queue.Empty:
+        break
+      if record is not None:
+        remaining.append(record)
+
+    # Send the rest from here, the writer thread dies with the process. What can't be sent is journaled.
+    if remaining:
+      self.send([self.encode(record) for record in remaining])
+
+  def stats(self):
+    return {
+      "queued": self.records.qsize(),
+      "sent": self.sent,
+      "journaled": self.journaled,
+    }
+
+def is_process_running(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True
+  return True
+
+trace_writer = None
+trace_writer_lock = threading.Lock()
+
+def get_trace_writer(endpoint=None, directory=None, queue_name="openmw-messages", journal_path=None):
+  # One writer per process, shared by every Model instance.
+  global trace_writer
+  with trace_writer_lock:
+    if trace_writer is None:
+      if directory:
+        sink = DirectorySink(directory)
+      else:
+        sink = QueueSink(endpoint, queue_name)
+      trace_writer = TraceWriter(sink, journal_path)
+    return trace_writer
@@ -1,6 +1,25 @@
 # add_disposition.py
 # For each document in the conversation container, generate a disposition
 # change document and write it to the disposition container.
+#
+# Completions run on a pool of worker threads, throttled by a token bucket
+# to stay under the api's requests/min and tokens/min limits, and retried
+# with exponential backoff when the api says to slow down (429). Finished
+# documents are upserted in batches through one container client, and
+# their ids are appended to a checkpoint file once they're written, so
+# a run that crashes resumes where it stopped. Delete the checkpoint file
+# to start over.
+#
+# The completion function and the output store are passed in to
+# run_pipeline(), so it can be run against a mock endpoint (set
+# OPENAI_API_BASE) or with MemoryStore instead of CosmosDB.
+#
+# The input containers are streamed and joined on id (see
+# ../document_join.py), so memory use doesn't grow with their size.
+# With COSMOS_LOCAL_STORE set, they're read from a local copy instead of
+# from CosmosDB: a dump from ../dump_db/dump_db.py, or the store kept up to
+# date by ../sync_db/sync_db.py. Only the documents synced since the last
+# run (the ones without a disposition yet) then cost an api call.
 
 # Requirements:
 # pip install azure-cosmos
@@ -9,23 +28,48 @@
 #
 # os.environ["COSMOS_CONNECTION_STRING"] - set to your cosmosdb connection string
 # os.environ["OPENAI_API_KEY"] - set to your openai api key
+# os.environ["COSMOS_LOCAL_STORE"] - optional, read the input containers from this local copy
 
+import concurrent.futures
 import os
-from azure.cosmos import CosmosClient
-from tqdm import tqdm
-import openai
+import random
 import re
+import sys
+import threading
+import time
 import uuid
 
-COSMOS_CONNECTION_STRING = os.environ['COSMOS_CONNECTION_STRING']
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import document_join
+import local_store
+
 COSMOS_DATABASE_NAME = 'openmw_conv'
 
-OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
 OPENAI_MODEL_NAME = 'gpt-3.5-turbo'
 OPENAI_MODEL_TEMPERATURE = 0.85
 
 FORCE_UPDATE_ALL = False
 
+# Rate limits of the openai account, requests and tokens (prompt + completion) per minute.
+REQUESTS_PER_MINUTE = int(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', 3500))
+TOKENS_PER_MINUTE = int(os.environ.get('OPENAI_TOKENS_PER_MINUTE', 90000))
+
+# Number of completions in flight at once.
+CONCURRENCY = int(os.environ.get('DISPOSITION_CONCURRENCY', 16))
+
+# Number of documents written to the disposition container at a time.
+UPSERT_BATCH_SIZE = 50
+
+# Ids of the documents already written, one per line.
+CHECKPOINT_PATH = os.environ.get('DISPOSITION_CHECKPOINT', 'add_disposition_change.checkpoint')
+
+# Retries for rate limited requests, waiting twice as long each time (plus jitter), up to MAX_BACKOFF seconds.
+MAX_RETRIES = 8
+MAX_BACKOFF = 60.0
+
+# Rough number of tokens in the reply, counted against the tokens/min limit before the real usage is known.
+EXPECTED_COMPLETION_TOKENS = 150
+
 # Input:
 json_input_container = 'js_input'
 json_output_container = 'js_output'
@@ -34,22 +78,95 @@ api_output_continer = 'api_output'
 # Output:
 disposition_container = 'disposition'
 
+class RateLimiter:
+    # Token bucket for requests and one for tokens, each refilling continuously at its per-minute rate.
+    # A request waits until both buckets have room for it.
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_rate = requests_per_minute / 60
+        self.token_rate = tokens_per_minute / 60
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+
+        self.requests = requests_per_minute
+        self.tokens = tokens_per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.request_capacity, self.requests + elapsed * self.request_rate)
+        self.tokens = min(self.token_capacity, self.tokens + elapsed * self.token_rate)
+
+    def acquire(self, tokens):
+        # Blocks until a request using about this many tokens can be sent.
+        tokens = min(tokens, self.token_capacity)
+        while True:
+            with self.lock:
+                self.refill()
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self.requests) / self.request_rate,
+                    (tokens - self.tokens) / self.token_rate,
+                )
+            time.sleep(wait)
+
+    def adjust(self, tokens):
+        # Corrects for the difference between a request's estimated and actual usage (may be negative).
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.token_capacity, self.tokens - tokens)
+
+class CosmosStore:
+    # Writes documents through a single container client.
+    def __init__(self, container):
+        self.container = container
+
+    def upsert_items(self, documents):
+        for document in documents:
+            self.container.upsert_item(document)
+
+class MemoryStore:
+    # In-memory stand-in for CosmosStore, for testing.
+    def __init__(self):
+        self.documents = {}
+
+    def upsert_items(self, documents):
+        for document in documents:
+            self.documents[document['id']] = document
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path, 'r') as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def add(self, document_ids):
+        # Only called once the documents are written, so an id in the file is always in the store.
+        with open(self.path, 'a') as f:
+            for document_id in document_ids:
+                f.write(document_id + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
 def get_collection(collection_name):
     return db.get_container_client(collection_name)
 
-def get_documents(collection):
-    return collection.query_items(
-        query='SELECT * FROM c',
-        enable_cross_partition_query=True
-    )
-
-def get_disposition_change_document_dict(json_input, json_output, api_output):
+def get_disposition_messages(json_input, json_output, api_output):
     # Construct the messages sent to the chat completion api
     messages = json_output['messages'].copy()
 
     # First, replace the final message with the player's original prompt
     # Replacing the message containing the actor's current disposition
-    messages[-1]["content"] = json_input['prompt']
+    messages[-1] = dict(messages[-1], content=json_input['prompt'])
 
     # Add the model's response to the dialogue
     messages.append({"role": "assistant", "content": api_output['choices'][0]['message']['content']})
@@ -73,13 +190,10 @@ For an example of scale:
 
 Feel free to use any number between the examples, depending on how strongly {actor_name} feels.'''
     messages.append({"role": "user", "content": disp_message})
+    return messages
 
-    response = openai.ChatCompletion.create(
-        model = OPENAI_MODEL_NAME,
-        temperature = OPENAI_MODEL_TEMPERATURE,
-        messages = messages,
-    )
-    response_text = response.choices[0]['message']['content']
+def get_disposition_change_document_dict(json_input, messages, response):
+    response_text = response['choices'][0]['message']['content']
 
     try:
         # Look for the disposition change, the number between square brackets
@@ -110,46 +224,171 @@ Feel free to use any number between the examples, depending on how strongly {act
         print(e)
         return None
 
-client = CosmosClient.from_connection_string(COSMOS_CONNECTION_STRING)
-db = client.get_database_client(COSMOS_DATABASE_NAME)
-
-json_input_documents_list = list(get_documents(get_collection(json_input_container)))
-json_input_documents_dict = {doc['id']: doc for doc in json_input_documents_list}
-
-json_output_documents_list = list(get_documents(get_collection(json_output_container)))
-json_output_documents_dict = {doc['id']: doc for doc in json_output_documents_list}
-
-api_output_documents_list = list(get_documents(get_collection(api_output_continer)))
-api_output_documents_dict = {doc['id']: doc for doc in api_output_documents_list}
-
-disposition_documents_list = list(get_documents(get_collection(disposition_container)))
-disposition_documents_dict = {doc['id']: doc for doc in disposition_documents_list}
-
-# Sanity check - Make sure there's the same number of documents in all 3 input containers
-# TODO: If this fails, maybe just fallback to the intersection of the three sets?
-assert len(json_input_documents_dict) == len(json_output_documents_dict) == len(api_output_documents_dict)
-
-documents_needing_updates = set(json_input_documents_dict.keys()) - set(disposition_documents_dict.keys())
+def openai_completion(messages):
+    # Default completion function, one chat completion request.
+    import openai
+    return openai.ChatCompletion.create(
+        model = OPENAI_MODEL_NAME,
+        temperature = OPENAI_MODEL_TEMPERATURE,
+        messages = messages,
+    )
 
-if FORCE_UPDATE_ALL:
-    documents_needing_updates = set(json_input_documents_dict.keys())
+def estimate_tokens(messages):
+    # About 4 characters per token, plus a few per message for the chat format, plus the expected reply.
+    return sum(len(message['content']) // 4 + 4 for message in messages) + EXPECTED_COMPLETION_TOKENS
 
-print(f'Found {len(documents_needing_updates)} documents needing updates')
+def is_rate_limit_error(e):
+    # openai.error.RateLimitError, or anything else that carries an http 429.
+    return type(e).__name__ == 'RateLimitError' or 429 in (getattr(e, 'http_status', None), getattr(e, 'status_code', None))
 
-for document_id in tqdm(documents_needing_updates):
-    json_input = json_input_documents_dict[document_id]
-    json_output = json_output_documents_dict[document_id]
-    api_output = api_output_documents_dict[document_id]
+def get_retry_after(e):
+    # Seconds the server asked us to wait, if it said.
+    headers = getattr(e, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after') or headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
 
-    disposition_change_document = get_disposition_change_document_dict(json_input, json_output, api_output)
+def complete_with_retry(complete, messages, rate_limiter, max_retries=MAX_RETRIES):
+    estimated_tokens = estimate_tokens(messages)
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire(estimated_tokens)
+        try:
+            response = complete(messages)
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == max_retries:
+                raise
+            backoff = get_retry_after(e) or min(MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1.5)
+            time.sleep(backoff)
+            continue
+
+        usage = response.get('usage')
+        if usage is not None:
+            rate_limiter.adjust(usage['total_tokens'] - estimated_tokens)
+        return response
+
+def process_document(complete, rate_limiter, json_input, json_output, api_output):
+    messages = get_disposition_messages(json_input, json_output, api_output)
+    response = complete_with_retry(complete, messages, rate_limiter)
+    return get_disposition_change_document_dict(json_input, messages, response)
+
+def run_pipeline(
+    documents,
+    complete,
+    store,
+    checkpoint = None,
+    rate_limiter = None,
+    concurrency = CONCURRENCY,
+    batch_size = UPSERT_BATCH_SIZE,
+    progress = None,
+    ):
+    # documents yields (document_id, json_input, json_output, api_output) for each document to augment.
+    # complete(messages) returns a chat completion response, store has upsert_items(documents).
+    # progress, if given, is updated once per document (e.g. a tqdm bar).
+    # Returns (written, failed) counts.
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+    written = 0
+    failed = 0
+    pending_documents = []
+
+    def flush():
+        nonlocal written
+        if not pending_documents:
+            return
+        store.upsert_items(pending_documents)
+        if checkpoint is not None:
+            checkpoint.add([document['id'] for document in pending_documents])
+        written += len(pending_documents)
+        pending_documents.clear()
+
+    def collect(done):
+        nonlocal failed
+        for future in done:
+            try:
+                document = future.result()
+            except Exception as e:
+                print(f'Error generating disposition change for document {in_flight[future]}: {type(e).__name__}: {e}')
+                document = None
+            del in_flight[future]
+            if document is None:
+                failed += 1
+            else:
+                pending_documents.append(document)
+            if progress is not None:
+                progress.update(1)
+        if len(pending_documents) >= batch_size:
+            flush()
+
+    # Only a couple of batches' worth of documents are in flight at a time, so memory doesn't grow with the input.
+    in_flight = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            for document_id, json_input, json_output, api_output in documents:
+                if len(in_flight) >= concurrency * 2:
+                    done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+                future = executor.submit(process_document, complete, rate_limiter, json_input, json_output, api_output)
+                in_flight[future] = document_id
+            while in_flight:
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+        finally:
+            # Whatever finished before an error (or Ctrl+C) still gets written and checkpointed.
+            flush()
+
+    return written, failed
+
+def main():
+    global db
+
+    from azure.cosmos import CosmosClient
+    from tqdm import tqdm
+    import openai
+
+    openai.api_key = os.environ['OPENAI_API_KEY']
+    if 'OPENAI_API_BASE' in os.environ:
+        openai.api_base = os.environ['OPENAI_API_BASE']
+
+    client = CosmosClient.from_connection_string(os.environ['COSMOS_CONNECTION_STRING'])
+    db = client.get_database_client(COSMOS_DATABASE_NAME)
+
+    store = CosmosStore(get_collection(disposition_container))
+    checkpoint = Checkpoint(CHECKPOINT_PATH)
+    finished_ids = checkpoint.load()
+
+    if 'COSMOS_LOCAL_STORE' in os.environ:
+        store_reader = local_store.LocalStore(os.environ['COSMOS_LOCAL_STORE'])
+        sources = {
+            container_name: store_reader.get_sorted_documents(container_name)
+            for container_name in [json_input_container, json_output_container, api_output_continer, disposition_container]
+        }
+    else:
+        # Only the ids of the existing disposition documents are needed, to skip them.
+        sources = {
+            json_input_container: document_join.get_sorted_documents(get_collection(json_input_container)),
+            json_output_container: document_join.get_sorted_documents(get_collection(json_output_container)),
+            api_output_continer: document_join.get_sorted_documents(get_collection(api_output_continer)),
+            disposition_container: document_join.get_sorted_documents(get_collection(disposition_container), document_join.SORTED_IDS_QUERY),
+        }
+    # Documents missing from any input container are skipped, and listed in the report at the end.
+    report = document_join.JoinReport(sources)
+    joined_documents = document_join.join_documents(
+        sources,
+        required=[json_input_container, json_output_container, api_output_continer],
+        report=report,
+    )
 
-    # Debug: print and break
-    #print(disposition_change_document)
-    #break
+    documents = (
+        (document_id, documents[json_input_container], documents[json_output_container], documents[api_output_continer])
+        for document_id, documents in joined_documents
+        if (FORCE_UPDATE_ALL or documents[disposition_container] is None) and document_id not in finished_ids
+    )
+    with tqdm(desc='Documents') as progress:
+        written, failed = run_pipeline(documents, openai_completion, store, checkpoint=checkpoint, progress=progress)
+    report.print()
+    print(f'Wrote {written} documents, {failed} failed')
 
-    if disposition_change_document is None:
-        continue
-    
-    # Write the disposition change document to the disposition container
-    disposition_collection = get_collection(disposition_container)
-    disposition_collection.upsert_item(disposition_change_document)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# document_join.py
+# Streaming join of the per-message containers (js_input, js_output,
+# api_output, disposition) on document id.
+#
+# Each container is read with an ORDER BY c.id query, so the documents
+# arrive sorted and can be merged one id at a time, the way a sort-merge
+# join works. Only the current document from each container is held in
+# memory, however large the containers are.
+#
+# Used by the augmentation and dataset scripts, which add this directory
+# to sys.path to import it.
+
+import heapq
+
+SORTED_QUERY = 'SELECT * FROM c ORDER BY c.id'
+SORTED_IDS_QUERY = 'SELECT c.id FROM c ORDER BY c.id'
+
+# Number of missing ids listed per container in the report.
+MAX_EXAMPLE_IDS = 5
+
+class JoinReport:
+    # Counts what the join found, instead of asserting every container has the same documents.
+    def __init__(self, names):
+        self.names = list(names)
+        self.ids = 0
+        self.complete = 0
+        self.missing = {name: 0 for name in self.names}
+        self.example_ids = {name: [] for name in self.names}
+
+    def add(self, document_id, documents):
+        self.ids += 1
+        if all(document is not None for document in documents.values()):
+            self.complete += 1
+            return
+        for name, document in documents.items():
+            if document is None:
+                self.missing[name] += 1
+                if len(self.example_ids[name]) < MAX_EXAMPLE_IDS:
+                    self.example_ids[name].append(document_id)
+
+    def print(self):
+        print(f'{self.ids} ids, {self.complete} in every container')
+        for name in self.names:
+            if self.missing[name] > 0:
+                print(f'  missing from {name}: {self.missing[name]} (e.g. {", ".join(self.example_ids[name])})')
+
+def get_sorted_documents(container, query=SORTED_QUERY):
+    # Documents from a container client, in id order.
+    return container.query_items(
+        query=query,
+        enable_cross_partition_query=True
+    )
+
+def check_sorted(name, documents):
+    # The merge silently drops matches if a source isn't sorted, so fail loudly instead.
+    previous_id = None
+    for document in documents:
+        document_id = document['id']
+        if previous_id is not None and document_id <= previous_id:
+            raise ValueError(f'{name} is not sorted by unique id: {document_id!r} came after {previous_id!r}')
+        previous_id = document_id
+        yield document_id, document
+
+def join_documents(sources, required=None, report=None):
+    # sources is {name: iterable of documents sorted by id}.
+    # Yields (id, {name: document or None}) for every id in any source, in id order (a full outer join).
+    # With required, ids missing from any of the required sources are skipped (an inner join on those).
+    # Every id, skipped or not, is counted in report if one is given.
+    required = set(required or ())
+    iterators = {name: check_sorted(name, documents) for name, documents in sources.items()}
+
+    heads = []
+    for name, iterator in iterators.items():
+        head = next(iterator, None)
+        if head is not None:
+            heads.append((head[0], name, head[1]))
+    heapq.heapify(heads)
+
+    while heads:
+        document_id = heads[0][0]
+        documents = dict.fromkeys(sources)
+        while heads and heads[0][0] == document_id:
+            _, name, document = heads[0]
+            documents[name] = document
+            head = next(iterators[name], None)
+            if head is None:
+                heapq.heappop(heads)
+            else:
+                heapq.heapreplace(heads, (head[0], name, head[1]))
+
+        if report is not None:
+            report.add(document_id, documents)
+        if all(documents[name] is not None for name in required):
+            yield document_id, documents
@@ -1,16 +1,32 @@
 # dump_db.py
-# Reads all documents from a CosmosDB collection and writes them to
-# local directories of json files.
+# Reads all documents from a CosmosDB collection and writes them to a
+# local corpus (see ../local_store.py): gzipped jsonl shards per
+# collection with an id index, readable by the dataset and augmentation
+# scripts with COSMOS_LOCAL_STORE=dump.
+#
+# Dumping into a directory that already has a dump adds a second copy of
+# every document (the newer one is the one that's read), so the store is
+# compacted afterwards to drop the old copies. Use ../sync_db to keep a
+# dump up to date instead.
+#
+# Pass --format json to write the old layout instead, every document as
+# its own pretty-printed dump/<collection>/<id>.json file.
 
 # Requirements:
 # pip install azure-cosmos
 # pip install tqdm
 
+import argparse
 import os
 import json
+import sys
 from azure.cosmos import CosmosClient
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import document_join
+import local_store
+
 COSMOS_CONNECTION_STRING = os.environ['COSMOS_CONNECTION_STRING']
 COSMOS_DATABASE_NAME = 'openmw_conv'
 
@@ -21,12 +37,20 @@ collections_to_dump = [
     'disposition',
 ]
 
+# Documents handed to the store at a time.
+WRITE_BATCH_SIZE = 1000
+
+parser = argparse.ArgumentParser(description='Dump the CosmosDB collections to local files.')
+parser.add_argument('--format', choices=['shards', 'json'], default='shards', help='compressed jsonl shards with an index (default), or one json file per document')
+parser.add_argument('--output', default='dump', help='output directory (default: dump)')
+args = parser.parse_args()
+
 client = CosmosClient.from_connection_string(COSMOS_CONNECTION_STRING)
 db = client.get_database_client(COSMOS_DATABASE_NAME)
 
-def dump_collection(collection, collection_name):
+def dump_collection_json(collection, collection_name):
     # Create a directory for the collection
-    os.makedirs(f'dump/{collection_name}', exist_ok=True)
+    os.makedirs(f'{args.output}/{collection_name}', exist_ok=True)
 
     # Read all documents from the collection
     for item in tqdm(collection.query_items(
@@ -34,9 +58,25 @@ def dump_collection(collection, collection_name):
         enable_cross_partition_query=True
     ), desc=collection_name):
         # Write each document to a json file
-        with open(f'dump/{collection_name}/{item["id"]}.json', 'w') as f:
+        with open(f'{args.output}/{collection_name}/{item["id"]}.json', 'w') as f:
             json.dump(item, f, indent=2)
 
+def dump_collection_shards(collection, collection_name, store):
+    # In id order, so the shards can be read back front to back.
+    batch = []
+    for item in tqdm(document_join.get_sorted_documents(collection), desc=collection_name):
+        batch.append(item)
+        if len(batch) >= WRITE_BATCH_SIZE:
+            store.put(collection_name, batch)
+            batch = []
+    store.put(collection_name, batch)
+
+store = local_store.LocalStore(args.output)
 for collection_name in tqdm(collections_to_dump, desc='Collections'):
     collection = db.get_container_client(collection_name)
-    dump_collection(collection, collection_name)
\ No newline at end of file
+    if args.format == 'json':
+        dump_collection_json(collection, collection_name)
+    else:
+        dump_collection_shards(collection, collection_name, store)
+        if store.compact_if_needed(collection_name):
+            print(f'{collection_name}: compacted')
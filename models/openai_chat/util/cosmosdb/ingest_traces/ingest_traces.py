@@ -0,0 +1,175 @@
+# ingest_traces.py
+# Loads openai_chat trace records straight into a local store (see
+# ../local_store.py), without going through the Azure queue and CosmosDB.
+#
+# Reads files of base64 encoded, gzipped trace records, one per line: the
+# files the tracing DirectorySink writes (TRACING_DIRECTORY), tracing
+# journals, or a dump of the queue's messages. Each record is split into
+# js_input, js_output and api_output documents, the same way the
+# queue-to-CosmosDB function does, so the dataset and augmentation scripts
+# can read them with COSMOS_LOCAL_STORE.
+#
+# The queue function gives every message a random id. Here the message id
+# is a hash of the record's json (not of the gzipped bytes, which include
+# the time they were compressed), and records whose id is already in the
+# store are skipped, so ingesting the same file twice doesn't add
+# anything. tracing.py gives every record a unique trace_id, so two turns
+# that happen to be identical still get their own ids. Records traced
+# before that was added don't have one, and identical ones among those
+# are only ingested once.
+#
+# Decoding and decompressing runs on a pool of processes, and the store is
+# written from the main one. Prints records/sec at the end, so it doubles
+# as an offline benchmark.
+#
+# Usage: python ingest_traces.py [--store store] [--workers N] path [path ...]
+#   where each path is a trace file or a directory of them
+
+import argparse
+import base64
+import binascii
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import local_store
+
+API_VERSION = 'v1'
+
+# Lines sent to a worker process at a time.
+CHUNK_SIZE = 256
+
+containers = {
+    'input_json': 'js_input',
+    'output_json': 'js_output',
+    'api_output': 'api_output',
+}
+
+def get_message_id(record):
+    # A uuid made from a hash of the record, serialized the same way whatever wrote it.
+    canonical = json.dumps(record, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return str(uuid.UUID(bytes=hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).digest()))
+
+def get_documents(blob):
+    # Returns {container_name: document} for one trace record, like the queue-to-CosmosDB function.
+    record = json.loads(gzip.decompress(blob))
+    message_id = get_message_id(record)
+
+    documents = {}
+    for key, container_name in containers.items():
+        document = dict(record[key])
+        if key == 'api_output':
+            document['original_id'] = document.get('id')
+        document['document_id'] = str(uuid.uuid4())
+        document['message_id'] = message_id
+        document['id'] = message_id
+        document['api_version'] = API_VERSION
+        documents[container_name] = document
+    return documents
+
+def decode_lines(lines):
+    # Runs in a worker process. Returns ({container_name: [documents]}, number of lines that couldn't be decoded).
+    documents = {container_name: [] for container_name in containers.values()}
+    errors = 0
+    for line in lines:
+        try:
+            record_documents = get_documents(base64.b64decode(line, validate=True))
+        except (binascii.Error, OSError, EOFError, ValueError, KeyError, TypeError):
+            errors += 1
+            continue
+        for container_name, document in record_documents.items():
+            documents[container_name].append(document)
+    return documents, errors
+
+def get_trace_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for file_name in sorted(os.listdir(path)):
+                # Skip files the DirectorySink hasn't finished writing.
+                if not file_name.startswith('.') and os.path.isfile(os.path.join(path, file_name)):
+                    yield os.path.join(path, file_name)
+        else:
+            yield path
+
+def get_chunks(paths, chunk_size=CHUNK_SIZE):
+    chunk = []
+    for path in get_trace_files(paths):
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    chunk.append(line)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+def ingest(paths, store, workers=None):
+    # Returns (records ingested, records skipped as already in the store, lines that couldn't be decoded).
+    workers = workers or os.cpu_count()
+    records = 0
+    duplicates = 0
+    errors = 0
+
+    def collect(done):
+        nonlocal records, duplicates, errors
+        for future in done:
+            documents, chunk_errors = future.result()
+            for container_name, container_documents in documents.items():
+                # The index includes everything put earlier in this run, so this also skips records repeated across chunks.
+                index = store.get_index(container_name)
+                new_documents = {}
+                for document in container_documents:
+                    if document['id'] not in index:
+                        new_documents.setdefault(document['id'], document)
+                store.put(container_name, new_documents.values())
+                if container_name == 'js_input':
+                    records += len(new_documents)
+                    duplicates += len(container_documents) - len(new_documents)
+            errors += chunk_errors
+            in_flight.remove(future)
+
+    # A few chunks per worker are queued at a time, so files of any size are read as they're needed.
+    in_flight = set()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk in get_chunks(paths):
+            if len(in_flight) >= workers * 2:
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            in_flight.add(executor.submit(decode_lines, chunk))
+        while in_flight:
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            collect(done)
+
+    # Message ids are hashes, so the documents were written in no particular order.
+    for container_name in containers.values():
+        store.compact_if_needed(container_name)
+
+    return records, duplicates, errors
+
+def main():
+    parser = argparse.ArgumentParser(description='Load trace files into a local store.')
+    parser.add_argument('paths', nargs='+', help='trace files, or directories of them')
+    parser.add_argument('--store', default=os.environ.get('COSMOS_LOCAL_STORE', 'store'), help='local store directory (default: $COSMOS_LOCAL_STORE, or store)')
+    parser.add_argument('--workers', type=int, default=0, help='decoding processes (default: one per cpu)')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    records, duplicates, errors = ingest(args.paths, local_store.LocalStore(args.store), workers=args.workers)
+    elapsed = time.perf_counter() - start
+
+    print(f'Ingested {records} records in {elapsed:.2f} s ({records / elapsed if elapsed > 0 else 0.0:.0f} records/s)')
+    if duplicates > 0:
+        print(f'Skipped {duplicates} records that were already in the store, or repeated')
+    if errors > 0:
+        print(f'Skipped {errors} lines that could not be decoded')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+# local_store.py
+# Compact local copy of the CosmosDB containers, written by dump_db.py
+# and kept up to date by sync.py.
+#
+# Each container is a directory of gzipped jsonl shards, one document per
+# line, plus an index of where each document is:
+#   <root>/<container>/shard-00000.jsonl.gz
+#   <root>/<container>/shard-00001.jsonl.gz
+#   <root>/<container>/index.tsv            id, shard, offset, length, line
+#
+# Shards are written as a series of independently compressed blocks of
+# about BLOCK_BYTES of json each (concatenated gzip members, so a shard is
+# still an ordinary .jsonl.gz file), and a new shard is started once one
+# reaches SHARD_BYTES. The index gives each document's block and line, so
+# reading one document only decompresses its block.
+#
+# Writes only ever append. A document that's written again (a sync of a
+# changed document, or dumping the same container twice) gets a new copy
+# and a new index line, and the last line for an id wins. The index line
+# is only written once its block is safely on disk, and a torn index line
+# or unindexed block left by a crash is cut off by the next write.
+#
+# get_sorted_documents() streams a container in id order, ready for
+# document_join.join_documents(). That's only cheap when the shards are
+# (mostly) in id order too, so every block is read once. Stores filled in
+# some other order (synced in _ts order, ingested traces with uuid ids)
+# are put back in order by compact(), which the writing scripts run via
+# compact_if_needed(). Compacting also drops superseded copies.
+
+import gzip
+import heapq
+import json
+import os
+import shutil
+
+# Size of the json in each compressed block, and of a shard file before the next one is started.
+BLOCK_BYTES = 256 * 2**10
+SHARD_BYTES = 64 * 2**20
+
+# gzip's default of 9 is several times slower to write, for a few percent smaller shards.
+COMPRESS_LEVEL = 6
+
+# Decompressed blocks kept while reading, for documents that aren't stored in id order.
+MAX_CACHED_BLOCKS = 8
+
+# Json sorted in memory at a time while compacting.
+RUN_BYTES = 64 * 2**20
+
+class LocalStore:
+    def __init__(self, root):
+        self.root = root
+        # container_name -> {id: (shard, offset, length, line)}, loaded when first needed.
+        self.indexes = {}
+        # container_name -> number of lines in index.tsv, superseded ones included.
+        self.index_lines = {}
+        # container_name -> size of index.tsv up to the end of its last well-formed line.
+        self.index_sizes = {}
+        # container_name -> (shard, offset) where the next block goes.
+        self.ends = {}
+
+    def get_container_path(self, container_name):
+        return os.path.join(self.root, container_name)
+
+    def get_shard_path(self, container_name, shard):
+        return os.path.join(self.get_container_path(container_name), f'shard-{shard:05d}.jsonl.gz')
+
+    def get_index_path(self, container_name):
+        return os.path.join(self.get_container_path(container_name), 'index.tsv')
+
+    def get_index(self, container_name):
+        if container_name not in self.indexes:
+            index = {}
+            index_lines = 0
+            index_size = 0
+            index_path = self.get_index_path(container_name)
+            if os.path.exists(index_path):
+                position = 0
+                with open(index_path, 'rb') as f:
+                    for line in f:
+                        position += len(line)
+                        # Skip lines a crash left half written.
+                        try:
+                            if not line.endswith(b'\n'):
+                                raise ValueError('no newline')
+                            document_id, shard, offset, length, block_line = line[:-1].decode('utf-8').split('\t')
+                            index[document_id] = (int(shard), int(offset), int(length), int(block_line))
+                        except ValueError:
+                            continue
+                        index_lines += 1
+                        index_size = position
+            self.indexes[container_name] = index
+            self.index_lines[container_name] = index_lines
+            self.index_sizes[container_name] = index_size
+        return self.indexes[container_name]
+
+    def put(self, container_name, documents):
+        # Adds or replaces documents, by id.
+        lines = []
+        for document in documents:
+            lines.append((document['id'], json.dumps(document, ensure_ascii=False)))
+        self.put_lines(container_name, lines)
+
+    def put_lines(self, container_name, lines):
+        # Adds or replaces documents given as (id, json) pairs.
+        index = self.get_index(container_name)
+        container_path = self.get_container_path(container_name)
+        os.makedirs(container_path, exist_ok=True)
+
+        if container_name not in self.ends:
+            # Carry on from the end of the last block in the index. Anything after it is a block whose
+            # index lines were never written, cut it off so the shard stays a valid gzip file.
+            shard, end = 0, 0
+            if index:
+                shard, offset, length, _ = max(index.values())
+                end = offset + length
+            shard_path = self.get_shard_path(container_name, shard)
+            if os.path.exists(shard_path) and os.path.getsize(shard_path) > end:
+                os.truncate(shard_path, end)
+            self.ends[container_name] = (shard, end)
+
+            # Same for a torn last line in the index, the next line would be appended to it.
+            index_path = self.get_index_path(container_name)
+            if os.path.exists(index_path) and os.path.getsize(index_path) > self.index_sizes[container_name]:
+                os.truncate(index_path, self.index_sizes[container_name])
+        shard, end = self.ends[container_name]
+
+        block = []
+        block_bytes = 0
+        with open(self.get_index_path(container_name), 'a') as index_file:
+            def write_block():
+                nonlocal shard, end, block_bytes
+                if end >= SHARD_BYTES:
+                    shard, end = shard + 1, 0
+                compressed_block = gzip.compress(''.join(line + '\n' for _, line in block).encode('utf-8'), compresslevel=COMPRESS_LEVEL)
+                # A new shard starts empty, even if a crash left an unindexed one behind.
+                with open(self.get_shard_path(container_name, shard), 'wb' if end == 0 else 'ab') as shard_file:
+                    shard_file.write(compressed_block)
+                    shard_file.flush()
+                    os.fsync(shard_file.fileno())
+
+                for block_line, (document_id, _) in enumerate(block):
+                    index[document_id] = (shard, end, len(compressed_block), block_line)
+                    index_file.write(f'{document_id}\t{shard}\t{end}\t{len(compressed_block)}\t{block_line}\n')
+                index_file.flush()
+                self.index_lines[container_name] += len(block)
+                end += len(compressed_block)
+                self.ends[container_name] = (shard, end)
+                block.clear()
+                block_bytes = 0
+
+            for document_id, line in lines:
+                if '\t' in document_id or '\n' in document_id:
+                    raise ValueError(f'document id {document_id!r} contains a tab or newline')
+                block.append((document_id, line))
+                block_bytes += len(line) + 1
+                if block_bytes >= BLOCK_BYTES:
+                    write_block()
+            if block:
+                write_block()
+        self.index_sizes[container_name] = os.path.getsize(self.get_index_path(container_name))
+
+    def get_ids(self, container_name):
+        return sorted(self.get_index(container_name))
+
+    def get(self, container_name, document_id):
+        # The document with this id, or None.
+        location = self.get_index(container_name).get(document_id)
+        if location is None:
+            return None
+        shard, offset, length, block_line = location
+        with open(self.get_shard_path(container_name, shard), 'rb') as f:
+            return json.loads(read_block(f, offset, length)[block_line])
+
+    def get_sorted_documents(self, container_name):
+        # Every document in the container, in id order, read one block at a time.
+        index = self.get_index(container_name)
+        shard_files = {}
+        blocks = {}
+        try:
+            for document_id in sorted(index):
+                shard, offset, length, block_line = index[document_id]
+                block = blocks.get((shard, offset))
+                if block is None:
+                    if shard not in shard_files:
+                        shard_files[shard] = open(self.get_shard_path(container_name, shard), 'rb')
+                    block = read_block(shard_files[shard], offset, length)
+                    if len(blocks) >= MAX_CACHED_BLOCKS:
+                        # Dicts keep insertion order, so this drops the block read longest ago.
+                        del blocks[next(iter(blocks))]
+                    blocks[(shard, offset)] = block
+                yield json.loads(block[block_line])
+        finally:
+            for shard_file in shard_files.values():
+                shard_file.close()
+
+    def count(self, container_name):
+        return len(self.get_index(container_name))
+
+    def needs_compaction(self, container_name):
+        # True if reading the container in id order would decompress blocks more than twice over,
+        # or if at least half of the copies in the shards have been superseded.
+        index = self.get_index(container_name)
+        if index and self.index_lines[container_name] >= 2 * len(index):
+            return True
+        blocks = {}
+        block_reads = 0
+        for document_id in sorted(index):
+            block = index[document_id][:2]
+            if block not in blocks:
+                block_reads += 1
+                if len(blocks) >= MAX_CACHED_BLOCKS:
+                    del blocks[next(iter(blocks))]
+                blocks[block] = True
+        distinct_blocks = len({location[:2] for location in index.values()})
+        return block_reads > 2 * distinct_blocks
+
+    def compact_if_needed(self, container_name):
+        # Returns True if the container was compacted.
+        if not self.needs_compaction(container_name):
+            return False
+        self.compact(container_name)
+        return True
+
+    def compact(self, container_name):
+        # Rewrites the container in id order, keeping only the current copy of each document.
+        # Sorts in runs of RUN_BYTES, so it doesn't need memory for the whole container.
+        index = self.get_index(container_name)
+        container_path = self.get_container_path(container_name)
+        temp_root = os.path.join(self.root, f'.compact-{container_name}')
+        shutil.rmtree(temp_root, ignore_errors=True)
+        os.makedirs(temp_root)
+
+        # Every block is read once, in the order it was written.
+        block_lines = {}
+        for document_id, (shard, offset, length, block_line) in index.items():
+            block_lines.setdefault((shard, offset, length), []).append((block_line, document_id))
+
+        run_paths = []
+        run = []
+        run_bytes = 0
+
+        def write_run():
+            nonlocal run_bytes
+            run.sort()
+            run_path = os.path.join(temp_root, f'run-{len(run_paths):05d}.tsv.gz')
+            with gzip.open(run_path, 'wt', encoding='utf-8', compresslevel=1) as f:
+                for document_id, line in run:
+                    f.write(f'{document_id}\t{line}\n')
+            run_paths.append(run_path)
+            run.clear()
+            run_bytes = 0
+
+        shard_files = {}
+        try:
+            for (shard, offset, length), wanted_lines in sorted(block_lines.items()):
+                if shard not in shard_files:
+                    shard_files[shard] = open(self.get_shard_path(container_name, shard), 'rb')
+                lines = read_block(shard_files[shard], offset, length)
+                for block_line, document_id in wanted_lines:
+                    run.append((document_id, lines[block_line]))
+                    run_bytes += len(lines[block_line])
+                if run_bytes >= RUN_BYTES:
+                    write_run()
+        finally:
+            for shard_file in shard_files.values():
+                shard_file.close()
+        if run:
+            write_run()
+
+        # Merge the sorted runs into a new copy of the container.
+        new_store = LocalStore(temp_root)
+        run_files = [gzip.open(run_path, 'rt', encoding='utf-8') for run_path in run_paths]
+        try:
+            runs = [(line.rstrip('\n').split('\t', 1) for line in run_file) for run_file in run_files]
+            batch = []
+            for document_id, line in heapq.merge(*runs):
+                batch.append((document_id, line))
+                if len(batch) >= 1000:
+                    new_store.put_lines(container_name, batch)
+                    batch = []
+            new_store.put_lines(container_name, batch)
+        finally:
+            for run_file in run_files:
+                run_file.close()
+
+        # Swap the new copy in.
+        old_path = os.path.join(self.root, f'.old-{container_name}')
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(container_path, old_path)
+        os.replace(new_store.get_container_path(container_name), container_path)
+        shutil.rmtree(old_path)
+        shutil.rmtree(temp_root)
+
+        for cache in (self.indexes, self.index_lines, self.index_sizes, self.ends):
+            cache.pop(container_name, None)
+
+def read_block(f, offset, length):
+    # The lines of one compressed block.
+    # Not splitlines(), json.dumps() leaves characters like U+2028 in strings, and it would split on those too.
+    f.seek(offset)
+    return gzip.decompress(f.read(length)).decode('utf-8').split('\n')[:-1]
@@ -1,6 +1,11 @@
 # make_dataset.py
 # Creates a Huggingface Dataset from the CosmosDB database.
 # Intended for creating a dataset to train T5 / some smaller text model.
+#
+# The containers are streamed and joined on id (see ../document_join.py),
+# and rows are written to a temporary jsonl file as they're generated and
+# loaded from there, so memory use doesn't grow with the size of the
+# database.
 
 # Requirements:
 # pip install azure-cosmos
@@ -8,16 +13,25 @@
 # pip install datasets
 #
 # os.environ["COSMOS_CONNECTION_STRING"] - set to your cosmosdb connection string
+# os.environ["COSMOS_LOCAL_STORE"] - optional, read from this local copy (a dump_db.py dump, or the store kept by ../sync_db/sync_db.py) instead
 
+import json
 import os
+import sys
+import tempfile
 from azure.cosmos import CosmosClient
 from tqdm import tqdm
 from datasets import Dataset, Value
 import random
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import document_join
+import local_store
+
 dataset_name = 'openmw_disposition'
 
-COSMOS_CONNECTION_STRING = os.environ['COSMOS_CONNECTION_STRING']
+LOCAL_STORE = os.environ.get('COSMOS_LOCAL_STORE')
+COSMOS_CONNECTION_STRING = os.environ['COSMOS_CONNECTION_STRING'] if LOCAL_STORE is None else None
 COSMOS_DATABASE_NAME = 'openmw_conv'
 
 collections_to_include = [
@@ -30,12 +44,6 @@ collections_to_include = [
 def get_collection(collection_name):
     return db.get_container_client(collection_name)
 
-def get_documents(collection):
-    return collection.query_items(
-        query='SELECT * FROM c',
-        enable_cross_partition_query=True
-    )
-
 def get_row(documents):
     api_output = documents['api_output']
     json_input = documents['js_input']
@@ -71,37 +79,33 @@ def get_row(documents):
         'output': output_str,
     }
 
-client = CosmosClient.from_connection_string(COSMOS_CONNECTION_STRING)
-db = client.get_database_client(COSMOS_DATABASE_NAME)
-
-
-# all_documents['api_output'][<id>]
-all_documents = {}
-
-for collection_name in tqdm(collections_to_include, desc='Collections'):
-    collection = get_collection(collection_name)
-    all_documents[collection_name] = {document['id']: document for document in list(get_documents(collection))}
-    print(f'{collection_name}: {len(all_documents[collection_name])}')
+if LOCAL_STORE is not None:
+    store = local_store.LocalStore(LOCAL_STORE)
+    sources = {
+        collection_name: store.get_sorted_documents(collection_name)
+        for collection_name in collections_to_include
+    }
+else:
+    client = CosmosClient.from_connection_string(COSMOS_CONNECTION_STRING)
+    db = client.get_database_client(COSMOS_DATABASE_NAME)
+    sources = {
+        collection_name: document_join.get_sorted_documents(get_collection(collection_name))
+        for collection_name in collections_to_include
+    }
+# Conversations missing from any collection are left out, and listed in the report at the end.
+report = document_join.JoinReport(sources)
 
 # Create a dataset from the documents
 # Dataset has the following columns:
 # - id: string, the conversation id
 # - input: string, the complete input for the model
 # - output: string, the output the model should produce
-dataset_rows = []
-
-all_message_ids = set(all_documents[collections_to_include[0]].keys())
-for conversation_id in all_message_ids:
-    #for collection_name in collections_to_include:
-    #    if conversation_id not in all_documents[collection_name]:
-    #        print(len(all_documents[collection_name]))
-    #        raise Exception(f'Conversation {conversation_id} not found in collection {collection_name}')
-    conversation_documents = {collection_name: all_documents[collection_name][conversation_id] for collection_name in collections_to_include}
-    dataset_rows.append(get_row(conversation_documents))
-
-
-column_names = dataset_rows[0].keys()
-dataset_dict = {column_name: [row[column_name] for row in dataset_rows] for column_name in column_names}
-
-dataset = Dataset.from_dict(dataset_dict)
-dataset.save_to_disk(dataset_name)
\ No newline at end of file
+with tempfile.TemporaryDirectory() as temp_directory:
+    rows_path = os.path.join(temp_directory, 'rows.jsonl')
+    with open(rows_path, 'w') as f:
+        for conversation_id, conversation_documents in tqdm(document_join.join_documents(sources, required=collections_to_include, report=report), desc='Conversations'):
+            f.write(json.dumps(get_row(conversation_documents)) + '\n')
+    report.print()
+
+    dataset = Dataset.from_json(rows_path)
+    dataset.save_to_disk(dataset_name)
@@ -0,0 +1,50 @@
+# sync_db.py
+# Brings a local copy of the CosmosDB containers up to date, fetching only
+# the documents that are new or changed since the last run (see ../sync.py).
+#
+# The augmentation and dataset scripts read from the local copy instead of
+# CosmosDB when COSMOS_LOCAL_STORE is set to its directory.
+
+# Requirements:
+# pip install azure-cosmos
+# pip install tqdm
+#
+# os.environ["COSMOS_CONNECTION_STRING"] - set to your cosmosdb connection string
+# os.environ["COSMOS_LOCAL_STORE"] - directory of the local copy (default: store)
+
+import os
+import sys
+from azure.cosmos import CosmosClient
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import local_store
+import sync
+
+COSMOS_CONNECTION_STRING = os.environ['COSMOS_CONNECTION_STRING']
+COSMOS_DATABASE_NAME = 'openmw_conv'
+
+LOCAL_STORE = os.environ.get('COSMOS_LOCAL_STORE', 'store')
+
+collections_to_sync = [
+    'api_output',
+    'js_input',
+    'js_output',
+    'disposition',
+]
+
+client = CosmosClient.from_connection_string(COSMOS_CONNECTION_STRING)
+db = client.get_database_client(COSMOS_DATABASE_NAME)
+
+store = local_store.LocalStore(LOCAL_STORE)
+os.makedirs(LOCAL_STORE, exist_ok=True)
+state = sync.SyncState(os.path.join(LOCAL_STORE, 'sync_state.json'))
+
+with tqdm(desc='Documents') as progress:
+    changed_ids = sync.sync(db.get_container_client, collections_to_sync, store, state, progress=progress)
+
+for collection_name in collections_to_sync:
+    print(f'{collection_name}: {len(changed_ids[collection_name])} new or changed')
+    # Synced documents are appended in _ts order, put them back in id order once enough of them pile up.
+    if store.compact_if_needed(collection_name):
+        print(f'{collection_name}: compacted')
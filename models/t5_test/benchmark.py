@@ -0,0 +1,147 @@
+'''
+Latency benchmark for the t5_test model on CPU.
+
+Usage: python -m models.t5_test.benchmark [--backend pytorch|int8|onnx] [--compare]
+           [--requests N] [--batch-size N] [--threads N] [--interop-threads N]
+           [--fast-tokenizer] [--warmup] [input_json ...]
+
+Loads the engine the same way the model does, runs the input jsons
+(by default, the openai_chat examples) round-robin, and reports load
+time, memory, tokens/sec and per-request latency percentiles.
+
+With --compare, the full precision pytorch model is loaded afterwards
+and run on the same inputs, to check how often the backend's output
+matches it exactly, how often the two pick the same next token given
+the same output so far, and how far apart their logits are.
+'''
+
+import argparse
+import glob
+import json
+import os
+import time
+
+from models.memory import get_rss, release_memory
+from models.t5_test import engine
+from models.t5_test.model import ONNX_DIRECTORY
+
+DEFAULT_INPUTS = os.path.join(os.path.dirname(__file__), "..", "openai_chat", "examples", "*.json")
+
+def parse_args():
+  parser = argparse.ArgumentParser(description="Measure t5_test latency on CPU.")
+  parser.add_argument("input_jsons", nargs="*", help="input json files to run (default: the openai_chat examples)")
+  parser.add_argument("--model", default="t5-small", help="T5 checkpoint to load (default: t5-small)")
+  parser.add_argument("--backend", default="pytorch", choices=engine.BACKENDS, help="backend to measure (default: pytorch)")
+  parser.add_argument("--compare", action="store_true", help="check the backend's output against the full precision pytorch model")
+  parser.add_argument("--requests", type=int, default=100, help="number of requests to time (default: 100)")
+  parser.add_argument("--batch-size", type=int, default=1, help="requests passed to generate() at a time (default: 1)")
+  parser.add_argument("--threads", type=int, default=0, help="intra-op threads (default: torch's choice)")
+  parser.add_argument("--interop-threads", type=int, default=0, help="inter-op threads (default: torch's choice)")
+  parser.add_argument("--fast-tokenizer", action="store_true", help="use the Rust tokenizer")
+  parser.add_argument("--warmup", action="store_true", help="run a warm-up request before timing, as T5_WARMUP=1 does")
+  return parser.parse_args()
+
+def main():
+  args = parse_args()
+
+  input_texts = []
+  for path in args.input_jsons or sorted(glob.glob(DEFAULT_INPUTS)):
+    with open(path, "r") as f:
+      input_texts.append(json.dumps(json.load(f)))
+
+  # Import the libraries first, so the memory figure is the model's and not theirs.
+  import torch
+  from transformers import T5ForConditionalGeneration, T5Tokenizer
+  if args.backend == "onnx":
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+
+  rss_before = get_rss()
+  t5_engine = engine.get_engine(
+    args.model,
+    backend=args.backend,
+    fast_tokenizer=args.fast_tokenizer,
+    warmup=args.warmup,
+    intra_op_threads=args.threads,
+    inter_op_threads=args.interop_threads,
+    onnx_directory=ONNX_DIRECTORY,
+  )
+  rss_after = get_rss()
+
+  latencies = []
+  start = time.perf_counter()
+  for i in range(0, args.requests, args.batch_size):
+    batch = [input_texts[(i + j) % len(input_texts)] for j in range(min(args.batch_size, args.requests - i))]
+    batch_start = time.perf_counter()
+    t5_engine.generate(batch, max_length=92)
+    # Every request in a batch waits for the whole batch.
+    latencies.extend([time.perf_counter() - batch_start] * len(batch))
+  total_time = time.perf_counter() - start
+  # Weights are memory mapped and only paged in as they're used, so loading alone can undercount.
+  # Trimming first leaves out heap that generate() has finished with but glibc hasn't handed back.
+  release_memory()
+  rss_after_requests = get_rss()
+
+  first_latency = latencies[0]
+  latencies.sort()
+  stats = t5_engine.stats()
+  print(f"model:             {args.model} ({args.backend})")
+  print(f"threads:           {stats['intra_op_threads']} intra-op, {stats['inter_op_threads']} inter-op")
+  print(f"load time:         {stats['load_time']:.2f} s")
+  if rss_before is not None:
+    print(f"memory:            {(rss_after - rss_before) / 2**20:.0f} MiB (resident, after loading)")
+    print(f"                   {(rss_after_requests - rss_before) / 2**20:.0f} MiB (resident, after the requests)")
+  if stats["warmup_time"] is not None:
+    print(f"warm-up:           {stats['warmup_time'] * 1000:.0f} ms")
+  print(f"requests:          {len(latencies)} (batch size {args.batch_size})")
+  print(f"first request:     {first_latency * 1000:.0f} ms")
+  print(f"throughput:        {len(latencies) / total_time:.2f} requests/s, {stats['tokens_per_second']:.1f} tokens/s")
+  print(f"latency p50:       {engine.percentile(latencies, 50) * 1000:.0f} ms")
+  print(f"latency p99:       {engine.percentile(latencies, 99) * 1000:.0f} ms")
+  print(f"latency mean:      {sum(latencies) / len(latencies) * 1000:.0f} ms")
+
+  if args.compare:
+    compare(t5_engine, args, input_texts)
+
+def compare(t5_engine, args, input_texts):
+  # Checks the backend against the full precision model on each distinct input. Besides whether the generated
+  # text is identical, both models are fed the full precision output one token at a time, to count how often
+  # they'd pick the same next token, and how far apart their logits get.
+  reference_engine = engine.get_engine(args.model, backend="pytorch", fast_tokenizer=args.fast_tokenizer)
+  outputs = t5_engine.generate(input_texts, max_length=92)
+  reference_outputs = reference_engine.generate(input_texts, max_length=92)
+
+  matches = sum(output == reference_output for output, reference_output in zip(outputs, reference_outputs))
+  print(f"matches pytorch:   {matches}/{len(input_texts)} outputs identical")
+  for output, reference_output in zip(outputs, reference_outputs):
+    if output != reference_output:
+      print(f"  {args.backend}: {output!r}")
+      print(f"  pytorch: {reference_output!r}")
+
+  agreeing_tokens = 0
+  tokens = 0
+  max_difference = 0.0
+  max_logit = 0.0
+  for input_text in input_texts:
+    inputs = reference_engine.tokenizer([input_text], return_tensors="pt")
+    with reference_engine.torch.inference_mode():
+      # Starts with the decoder start token, which is what each position is predicted from.
+      decoder_input_ids = reference_engine.model.generate(**inputs, max_length=92)[:, :-1]
+    logits = get_logits(t5_engine, input_text, decoder_input_ids)
+    reference_logits = get_logits(reference_engine, input_text, decoder_input_ids)
+
+    agreeing_tokens += int((logits.argmax(-1) == reference_logits.argmax(-1)).sum())
+    tokens += decoder_input_ids.shape[1]
+    max_difference = max(max_difference, float((logits - reference_logits).abs().max()))
+    max_logit = max(max_logit, float(reference_logits.abs().max()))
+  print(f"next token:        {agreeing_tokens}/{tokens} the same as pytorch")
+  print(f"logits:            {max_difference:.3g} largest difference (largest pytorch logit {max_logit:.3g})")
+
+def get_logits(t5_engine, input_text, decoder_input_ids):
+  # The model's logits at each position of decoder_input_ids, in one forward pass.
+  inputs = t5_engine.tokenizer([input_text], return_tensors="pt")
+  with t5_engine.torch.inference_mode():
+    return t5_engine.model(**inputs, decoder_input_ids=decoder_input_ids).logits[0].float()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,69 @@
+'''
+Memory-bounded cache of T5 encoder outputs, keyed on input token ids.
+
+T5's encoder is bidirectional, so every encoder state depends on every
+input token, and a cached state can only be reused for exactly the same
+input. Entries are stored with their size in bytes, and the least
+recently used ones are evicted once the total is over max_bytes.
+'''
+
+import collections
+import threading
+
+class EncoderCache:
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.entries = collections.OrderedDict()  # tuple of token ids -> (state, size)
+    self.total_bytes = 0
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, token_ids):
+    # The state cached for exactly these token ids, or None.
+    key = tuple(token_ids)
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, token_ids, state, size):
+    # size is the state's size in bytes.
+    if size > self.max_bytes:
+      return
+    key = tuple(token_ids)
+    with self.lock:
+      old_entry = self.entries.pop(key, None)
+      if old_entry is not None:
+        self.total_bytes -= old_entry[1]
+      self.entries[key] = (state, size)
+      self.total_bytes += size
+      while self.total_bytes > self.max_bytes:
+        _, (_, evicted_size) = self.entries.popitem(last=False)
+        self.total_bytes -= evicted_size
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        "entries": len(self.entries),
+        "bytes": self.total_bytes,
+      }
+
+def get_state_size(state):
+  # Size in bytes of a tensor, or of every tensor in a (nested) tuple, list or dict of them.
+  if hasattr(state, "element_size") and hasattr(state, "nelement"):
+    return state.element_size() * state.nelement()
+  if isinstance(state, dict):
+    return sum(get_state_size(value) for value in state.values())
+  if isinstance(state, (tuple, list)):
+    return sum(get_state_size(value) for value in state)
+  return 0
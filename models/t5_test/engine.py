@@ -0,0 +1,237 @@
+'''
+CPU inference engine for T5.
+
+Loads the tokenizer and model once per process and keeps them resident,
+so every Model instance (and anything else that wants T5, like the
+openai_chat history summariser) shares one copy. Inference runs under
+torch.inference_mode(), with torch's CPU thread pools sized up front.
+A short warm-up request can also be run at load time, for the first
+real request not to pay for lazy initialisation.
+
+There are three backends:
+  "pytorch"  The full precision model, as transformers loads it.
+  "int8"     The same model with its linear layers dynamically quantized to int8.
+             About half the memory, and faster on CPU, at a small cost in accuracy.
+  "onnx"     The model exported to ONNX (an encoder, and a decoder that reuses the attention
+             cache from one generated token to the next) and run with onnxruntime.
+             Somewhat faster on CPU, but more memory, as the encoder and decoder each keep a copy of
+             the embeddings. Needs requirements-onnx.txt. The export is saved, and reused by later runs.
+Measure them with benchmark.py, --compare checks their output against "pytorch".
+
+torch and transformers are only imported when an engine is created.
+'''
+
+import collections
+import math
+import os
+import shutil
+import threading
+import time
+
+from models.memory import release_memory
+from models.t5_test import encoder_cache
+
+BACKENDS = ("pytorch", "int8", "onnx")
+
+# Where ONNX exports are kept between runs.
+DEFAULT_ONNX_DIRECTORY = os.path.expanduser("~/.cache/ml-interface/onnx")
+
+class T5Engine:
+  def __init__(self,
+    model_name = "t5-small",
+    backend = "pytorch",
+    fast_tokenizer = False,
+    warmup = False,
+    onnx_directory = DEFAULT_ONNX_DIRECTORY,
+    onnx_threads = (0, 0),
+    encoder_cache_bytes = 0,
+    ):
+    # onnx_threads is (intra-op, inter-op) for onnxruntime, which has its own thread pools. 0 leaves its default.
+    # encoder_cache_bytes keeps the encoder outputs of recent inputs, so an input that comes up again
+    # only runs the decoder. 0 disables it. Not used with the onnx backend.
+    if backend not in BACKENDS:
+      raise ValueError(f"unknown backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+
+    # transformers is slow to import, wait until the engine is actually created.
+    import torch
+    if fast_tokenizer:
+      # The Rust tokenizer, needs the tokenizers package.
+      from transformers import T5TokenizerFast as T5Tokenizer
+    else:
+      from transformers import T5Tokenizer
+
+    self.torch = torch
+    self.model_name = model_name
+    self.backend = backend
+
+    start = time.perf_counter()
+    self.tokenizer = T5Tokenizer.from_pretrained(model_name, model_max_length=92)
+    if backend == "onnx":
+      self.model = load_onnx_model(model_name, onnx_directory, *onnx_threads)
+    else:
+      from transformers import T5ForConditionalGeneration
+      self.model = T5ForConditionalGeneration.from_pretrained(model_name)
+      self.model.eval()
+      if backend == "int8":
+        # Quantizes a copy, and the full precision original is dropped. Quantizing in place keeps the float weights resident.
+        self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+    # Hand back what loading freed (the full precision model int8 replaced, onnxruntime's graph optimisation),
+    # or it stays resident.
+    release_memory()
+    self.load_time = time.perf_counter() - start
+
+    # torch already spreads each request over every intra-op thread, running two at once only makes them fight.
+    self.lock = threading.Lock()
+
+    self.encoder_cache = None
+    if encoder_cache_bytes > 0 and backend != "onnx":
+      self.encoder_cache = encoder_cache.EncoderCache(encoder_cache_bytes)
+
+    self.stats_lock = threading.Lock()
+    self.requests = 0
+    self.generated_tokens = 0
+    self.generate_time = 0.0
+    self.latencies = collections.deque(maxlen=1000)
+
+    self.warmup_time = None
+    if warmup:
+      start = time.perf_counter()
+      self.generate(["translate English to German: Hello."], max_length=8)
+      self.warmup_time = time.perf_counter() - start
+      self.requests = 0
+      self.generated_tokens = 0
+      self.generate_time = 0.0
+      self.latencies.clear()
+
+  def generate(self, input_texts, max_length=92, max_input_length=None):
+    # Returns the generated text for each input text.
+    # Inputs longer than max_input_length tokens are truncated, by default they're passed through as-is.
+    start = time.perf_counter()
+    if max_input_length is None:
+      inputs = self.tokenizer(input_texts, return_tensors="pt", padding=True)
+    else:
+      inputs = self.tokenizer(input_texts, return_tensors="pt", padding=True, truncation=True, max_length=max_input_length)
+
+    with self.lock, self.torch.inference_mode():
+      if self.encoder_cache is not None and len(input_texts) == 1:
+        outputs = self.generate_with_encoder_cache(inputs, max_length)
+      else:
+        outputs = self.model.generate(**inputs, max_length=max_length)
+    output_texts = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+    # For T5 the decoder start token is the pad token, so this counts only generated tokens, not the start or padding.
+    generated_tokens = int((outputs != self.tokenizer.pad_token_id).sum())
+
+    # Latencies are per call, requests counts each input in a batch.
+    latency = time.perf_counter() - start
+    with self.stats_lock:
+      self.requests += len(input_texts)
+      self.generated_tokens += generated_tokens
+      self.generate_time += latency
+      self.latencies.append(latency)
+    return output_texts
+
+  def generate_with_encoder_cache(self, inputs, max_length):
+    # T5's encoder is bidirectional, so its outputs can only be reused for exactly the same input.
+    token_ids = inputs["input_ids"][0].tolist()
+    encoder_outputs = self.encoder_cache.get(token_ids)
+    if encoder_outputs is None:
+      encoder_outputs = self.model.get_encoder()(**inputs, return_dict=True)
+      self.encoder_cache.put(token_ids, encoder_outputs, encoder_cache.get_state_size(encoder_outputs))
+    return self.model.generate(attention_mask=inputs["attention_mask"], encoder_outputs=encoder_outputs, max_length=max_length)
+
+  def stats(self):
+    with self.stats_lock:
+      latencies = sorted(self.latencies)
+    stats = {
+      "model": self.model_name,
+      "backend": self.backend,
+      "load_time": self.load_time,
+      "warmup_time": self.warmup_time,
+      "requests": self.requests,
+      "tokens_per_second": self.generated_tokens / self.generate_time if self.generate_time > 0 else 0.0,
+      "p50_latency": percentile(latencies, 50),
+      "p99_latency": percentile(latencies, 99),
+      "intra_op_threads": self.torch.get_num_threads(),
+      "inter_op_threads": self.torch.get_num_interop_threads(),
+    }
+    if self.encoder_cache is not None:
+      stats["encoder_cache"] = self.encoder_cache.stats()
+    return stats
+
+def load_onnx_model(model_name, onnx_directory, intra_op_threads=0, inter_op_threads=0):
+  # Exports the model the first time, loads the saved export after that.
+  import onnxruntime
+  from optimum.onnxruntime import ORTModelForSeq2SeqLM
+
+  session_options = onnxruntime.SessionOptions()
+  session_options.intra_op_num_threads = intra_op_threads
+  session_options.inter_op_num_threads = inter_op_threads
+  # The arena keeps the largest request's buffers for good, and generating measured no faster with it.
+  session_options.enable_cpu_mem_arena = False
+
+  export_path = os.path.join(onnx_directory, model_name.strip('/').replace('/', '--'))
+  if not os.path.isdir(export_path):
+    export_onnx_model(model_name, export_path)
+  return ORTModelForSeq2SeqLM.from_pretrained(export_path, use_cache=True, session_options=session_options)
+
+def export_onnx_model(model_name, export_path):
+  # The decoder for the first token and the one that reuses past key/values are merged into one file,
+  # so their weights are only loaded once, and the separate copies are deleted.
+  # Exports to a temporary directory first, so an interrupted export is never loaded.
+  from optimum.exporters.onnx import main_export
+
+  temp_path = export_path + ".tmp"
+  shutil.rmtree(temp_path, ignore_errors=True)
+  main_export(model_name, output=temp_path, task="text2text-generation-with-past")
+  if os.path.exists(os.path.join(temp_path, "decoder_model_merged.onnx")):
+    for file_name in ("decoder_model.onnx", "decoder_with_past_model.onnx"):
+      os.remove(os.path.join(temp_path, file_name))
+  os.replace(temp_path, export_path)
+
+def percentile(sorted_values, percent):
+  # Nearest-rank percentile, None if there are no values.
+  if not sorted_values:
+    return None
+  rank = math.ceil(len(sorted_values) * percent / 100)
+  return sorted_values[max(rank, 1) - 1]
+
+def configure_threads(intra_op_threads=0, inter_op_threads=0):
+  # 0 leaves torch's default (one intra-op thread per physical core).
+  # torch only allows the inter-op pool to be sized before it's used, so this has to happen before any inference.
+  import torch
+  if intra_op_threads > 0:
+    torch.set_num_threads(intra_op_threads)
+  if inter_op_threads > 0:
+    try:
+      torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError:
+      # Already set, or something already ran in parallel.
+      pass
+
+engines = {}
+engines_lock = threading.Lock()
+
+def get_engine(model_name="t5-small", backend="pytorch", fast_tokenizer=False, warmup=False, intra_op_threads=0, inter_op_threads=0, onnx_directory=DEFAULT_ONNX_DIRECTORY, encoder_cache_bytes=0):
+  # One engine per model and backend per process. The thread settings only apply to the first engine created.
+  with engines_lock:
+    key = (model_name, backend, fast_tokenizer)
+    if key not in engines:
+      if not engines:
+        configure_threads(intra_op_threads, inter_op_threads)
+      engines[key] = T5Engine(model_name,
+        backend=backend,
+        fast_tokenizer=fast_tokenizer,
+        warmup=warmup,
+        onnx_directory=onnx_directory,
+        onnx_threads=(intra_op_threads, inter_op_threads),
+        encoder_cache_bytes=encoder_cache_bytes,
+      )
+    return engines[key]
+
+def release_engine(t5_engine):
+  # Forget the engine, so the next get_engine() call loads a new one and this one can be freed.
+  with engines_lock:
+    for key, value in list(engines.items()):
+      if value is t5_engine:
+        del engines[key]
@@ -3,22 +3,88 @@ t5_test model
 Executes Google's T5 model on the input json file and returns the output.
 The model itself is one of the defaults provided by the transformers library.
 It will likely have poor performance, but works as a test.
+The model's input is the request re-serialized as compact json (json.dumps),
+not the input file's original text, so its whitespace doesn't reach the tokenizer.
 '''
 
 # Requirements:
 #   pip install transformers   |   conda install -c conda-forge transformers
 #   pip install sentencepiece  |   conda install -c conda-forge sentencepiece
 
-from transformers import T5Tokenizer, T5ForConditionalGeneration
+import json
+import os
+from models import BaseModel, read_input_json
+from models.t5_test import engine
+
+######################### Configuration
+# Model
+# Any T5 checkpoint transformers can load.
+MODEL_NAME = os.environ.get("T5_MODEL", "t5-small")
+
+# Backend
+# "pytorch" (full precision), "int8" (dynamically quantized, smaller and usually faster on CPU),
+# or "onnx" (exported to ONNX and run with onnxruntime, needs requirements-onnx.txt). See engine.py.
+# Compare them with `python -m models.t5_test.benchmark --backend <backend> --compare`.
+BACKEND = os.environ.get("T5_BACKEND", "pytorch")
+
+# ONNX export directory
+# The model is exported here the first time the onnx backend is used.
+ONNX_DIRECTORY = os.environ.get("T5_ONNX_DIR", engine.DEFAULT_ONNX_DIRECTORY)
+
+# CPU threads
+# Threads torch uses inside each operation (intra-op), and to run independent operations at the same time (inter-op).
+# 0 leaves it up to torch, which uses one intra-op thread per physical core.
+INTRA_OP_THREADS = int(os.environ.get("T5_INTRA_OP_THREADS", 0))
+INTER_OP_THREADS = int(os.environ.get("T5_INTER_OP_THREADS", 0))
+
+# Fast tokenizer
+# Use the Rust tokenizer instead of sentencepiece, needs the tokenizers package.
+FAST_TOKENIZER = os.environ.get("T5_FAST_TOKENIZER", "") == "1"
+
+# Encoder cache
+# Megabytes of encoder outputs to keep for recently seen inputs, so repeating an input only runs the decoder.
+# Only exact repeats can be reused, since T5's encoder looks at the whole input at once, and successive
+# dialogue turns never repeat. Off (0) by default, turn it on for workloads that resend the same input.
+ENCODER_CACHE_MB = float(os.environ.get("T5_ENCODER_CACHE_MB", 0))
+
+# Warm-up
+# Run a short request when the model is loaded, so the first real request doesn't pay for initialisation.
+# Off by default: on CPU the first request measured no faster with it, and every one-shot run paid for the extra request.
+WARMUP = os.environ.get("T5_WARMUP", "0") == "1"
+#########################
+
+class Model(BaseModel):
+  # predict_batch() pads everything into one generate() call, let the server batch requests together.
+  micro_batching = True
+
+  local = True
 
-class Model:
   def __init__(self):
-    self.tokenizer = T5Tokenizer.from_pretrained('t5-small', model_max_length=92)
-    self.model = T5ForConditionalGeneration.from_pretrained('t5-small')
-  
+    # Shared with every other Model instance in the process, see engine.py
+    self.engine = engine.get_engine(
+      MODEL_NAME,
+      backend=BACKEND,
+      fast_tokenizer=FAST_TOKENIZER,
+      warmup=WARMUP,
+      intra_op_threads=INTRA_OP_THREADS,
+      inter_op_threads=INTER_OP_THREADS,
+      onnx_directory=ONNX_DIRECTORY,
+      encoder_cache_bytes=int(ENCODER_CACHE_MB * 2**20),
+    )
+
   def predict(self, input_json):
-    with open(input_json, "r") as f:
-      input_text = f.read()
-    input_ids = self.tokenizer.encode(input_text, return_tensors="pt")
-    outputs = self.model.generate(input_ids, max_length=92)
-    return self.tokenizer.decode(outputs[0], skip_special_tokens=True)
\ No newline at end of file
+    input_text = json.dumps(read_input_json(input_json))
+    return self.engine.generate([input_text], max_length=92)[0]
+
+  def predict_batch(self, input_jsons):
+    # Pad every request to the same length and run them through generate() together.
+    input_texts = [json.dumps(read_input_json(input_json)) for input_json in input_jsons]
+    return self.engine.generate(input_texts, max_length=92)
+
+  def unload(self):
+    # The engine is shared, it's only freed once nothing else (e.g. the openai_chat summariser) holds on to it.
+    engine.release_engine(self.engine)
+    self.engine = None
+
+  def get_stats(self):
+    return self.engine.stats()